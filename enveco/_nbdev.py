@@ -7,17 +7,35 @@ index = {"open_geotiff": "00_data.image.ipynb",
          "calc_avi": "00_data.image.ipynb",
          "calc_savi": "00_data.image.ipynb",
          "calc_gci": "00_data.image.ipynb",
+         "circle_mask": "00_data.image.ipynb",
+         "plot_mask": "00_data.image.ipynb",
          "mask_plot_from_image": "00_data.image.ipynb",
+         "batch_image_metrics": "00_data.image.ipynb",
          "image_metrics": "00_data.image.ipynb",
+         "image_metric_names": "00_data.image.ipynb",
+         "quantize_grey_levels": "00_data.image.ipynb",
+         "cooccurrence_matrix": "00_data.image.ipynb",
          "glcm_xplusy": "00_data.image.ipynb",
          "glcm_xminusy": "00_data.image.ipynb",
+         "glcm_features": "00_data.image.ipynb",
          "textural_features": "00_data.image.ipynb",
+         "stack_textural_features": "00_data.image.ipynb",
+         "glcm_feature_names": "00_data.image.ipynb",
          "process_image_features": "00_data.image.ipynb",
+         "iter_plot_windows": "00_data.image.ipynb",
+         "plot_window_features": "00_data.image.ipynb",
+         "feature_map": "00_data.image.ipynb",
+         "spectral_index_funcs": "00_data.image.ipynb",
+         "spectral_index_raster": "00_data.image.ipynb",
          "plot_point_cloud": "01_data.las.ipynb",
          "plot_2d_views": "01_data.las.ipynb",
+         "PointCloud": "01_data.las.ipynb",
          "las_to_df": "01_data.las.ipynb",
          "mask_plot_from_lidar": "01_data.las.ipynb",
+         "PlotIndex": "01_data.las.ipynb",
+         "las_dims": "01_data.las.ipynb",
          "normalized_shannon_entropy": "01_data.las.ipynb",
+         "HeightSketch": "01_data.las.ipynb",
          "height_metrics": "01_data.las.ipynb",
          "z_stats": "01_data.las.ipynb",
          "z_percentages": "01_data.las.ipynb",
@@ -38,16 +56,38 @@ index = {"open_geotiff": "00_data.image.ipynb",
          "class_cols": "01_data.las.ipynb",
          "density_metrics": "01_data.las.ipynb",
          "density_cols": "01_data.las.ipynb",
+         "stdmetrics": "01_data.las.ipynb",
          "point_cloud_metrics": "01_data.las.ipynb",
          "point_cloud_metric_cols": "01_data.las.ipynb",
+         "voxel_counts": "01_data.las.ipynb",
+         "fill_bottom_voxels": "01_data.las.ipynb",
+         "SparseVoxels": "01_data.las.ipynb",
          "VoxelImage": "01_data.las.ipynb",
          "get_las_data": "01_data.las.ipynb",
          "get_3d_grid": "01_data.las.ipynb",
          "VoxelBlock": "01_data.las.ipynb",
+         "VoxelDihedral": "01_data.las.ipynb",
          "LasColReader": "01_data.las.ipynb",
+         "densify_voxels": "01_data.las.ipynb",
+         "sparse_collate": "01_data.las.ipynb",
+         "VoxelStore": "01_data.las.ipynb",
          "VoxelDataLoaders": "01_data.las.ipynb",
          "VoxelDataLoaders.from_csv": "01_data.las.ipynb",
+         "grid_metrics": "01_data.las.ipynb",
          "lastile_to_df": "01_data.las.ipynb",
+         "grid_to_raster": "01_data.las.ipynb",
+         "lastile_to_raster": "01_data.las.ipynb",
+         "iter_las_chunks": "01_data.las.ipynb",
+         "PointCloudStats": "01_data.las.ipynb",
+         "stream_grid_metrics": "01_data.las.ipynb",
+         "stream_plot_metrics": "01_data.las.ipynb",
+         "FeatureCache": "02_tabular.preprocessing.ipynb",
+         "IOStats": "02_tabular.preprocessing.ipynb",
+         "batch_features": "02_tabular.preprocessing.ipynb",
+         "batch_point_cloud_metrics": "02_tabular.preprocessing.ipynb",
+         "batch_image_features": "02_tabular.preprocessing.ipynb",
+         "FeatureStore": "02_tabular.preprocessing.ipynb",
+         "update_feature_table": "02_tabular.preprocessing.ipynb",
          "EnvecoPreprocessor": "02_tabular.preprocessing.ipynb",
          "process_one": "02_tabular.preprocessing.ipynb",
          "inception_learner": "03_model.inception3dv3.ipynb",
@@ -71,6 +111,8 @@ index = {"open_geotiff": "00_data.image.ipynb",
          "bias.__doc__": "05_metrics.ipynb",
          "bias_pct": "05_metrics.ipynb",
          "bias_pct.__doc__": "05_metrics.ipynb",
+         "StackedTabularModel": "06_model.ensemble.ipynb",
+         "StackedLoss": "06_model.ensemble.ipynb",
          "Ensemble": "06_model.ensemble.ipynb",
          "Ensemble.export": "06_model.ensemble.ipynb",
          "load_ensemble": "06_model.ensemble.ipynb",
@@ -78,7 +120,10 @@ index = {"open_geotiff": "00_data.image.ipynb",
          "calc_same_padding_2d": "07_model.alexnet.ipynb",
          "PaddedConv2d": "07_model.alexnet.ipynb",
          "PaddedMaxPool2d": "07_model.alexnet.ipynb",
-         "AlexNetVoxel": "07_model.alexnet.ipynb"}
+         "AlexNetVoxel": "07_model.alexnet.ipynb",
+         "StageProfiler": "08_profiling.ipynb",
+         "profile_stage": "08_profiling.ipynb",
+         "profile_plot": "08_profiling.ipynb"}
 
 modules = ["data/image.py",
            "data/las.py",
@@ -87,7 +132,8 @@ modules = ["data/image.py",
            "interpretation.py",
            "metrics.py",
            "model/ensemble.py",
-           "model/alexnet.py"]
+           "model/alexnet.py",
+           "profiling.py"]
 
 doc_url = "https://jaeeolma.github.io/enveco/"
 
@@ -1,8 +1,10 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_data.image.ipynb (unless otherwise specified).
 
-__all__ = ['open_geotiff', 'calc_normalized_spectral_index', 'calc_avi', 'calc_savi', 'calc_gci',
-           'mask_plot_from_image', 'image_metrics', 'glcm_xplusy', 'glcm_xminusy', 'textural_features',
-           'process_image_features']
+__all__ = ['open_geotiff', 'calc_normalized_spectral_index', 'calc_avi', 'calc_savi', 'calc_gci', 'circle_mask',
+           'plot_mask', 'mask_plot_from_image', 'batch_image_metrics', 'image_metrics', 'image_metric_names',
+           'quantize_grey_levels', 'cooccurrence_matrix', 'glcm_xplusy', 'glcm_xminusy', 'glcm_features',
+           'textural_features', 'stack_textural_features', 'glcm_feature_names', 'process_image_features',
+           'iter_plot_windows', 'plot_window_features', 'feature_map', 'spectral_index_funcs', 'spectral_index_raster']
 
 # Cell
 import rasterio as rio
@@ -11,21 +13,29 @@ import matplotlib.pyplot as plt
 from typing import List
 import pandas as pd
 import skimage
-from skimage.feature import greycomatrix, greycoprops
-from itertools import product
+from itertools import product, islice
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from ..profiling import profile_stage
 
 # Cell
 def open_geotiff(fn, bands:List[int]=None) -> np.ndarray:
     """Open geotiff image from path, cast it to float and scale it to 0-1 range, optionally with only `bands` input bands."
     Returns numpy array of shape (C,W,H)
     """
-    with rio.open(str(fn)) as f:
+    with profile_stage('tif_read') as st, rio.open(str(fn)) as f:
         data = f.read()
         data = data.astype(np.float32)
         data /= 255.
+        st.n = f.width * f.height
     if bands is not None: data = data[bands]
     return data
 
+def _as_image(fn) -> np.ndarray:
+    "Return `fn` if it is already an image array, otherwise open it with `open_geotiff`"
+    return fn if isinstance(fn, np.ndarray) else open_geotiff(fn)
+
 # Cell
 def calc_normalized_spectral_index(im:np.ndarray, band_1:int, band_2:int) -> np.ndarray:
     "Calculate normalized spectral index (band_1 - band_2)/(band_1 + band_2). Can be used with NDVI and such simple indices"
@@ -45,12 +55,20 @@ def calc_gci(im:np.ndarray, nir:int, green:int) -> np.ndarray:
 
 # Cell
 
+def circle_mask(x:np.ndarray, y:np.ndarray, center_x:float, center_y:float, radius:float) -> np.ndarray:
+    """Boolean mask of coordinates `(x, y)` within `radius` from `(center_x, center_y)`.
+    Inputs are broadcast against each other, so `np.ogrid` grids work as well as point arrays"""
+    return (x - center_x)**2 + (y - center_y)**2 <= radius**2
+
+def plot_mask(shape:tuple, radius:float=31) -> np.ndarray:
+    "Boolean mask of the field plot of radius (radius-1) pixels in the middle of an image of `shape` (H, W)"
+    center = (int(shape[0]/2), int(shape[1]/2))
+    Y, X = np.ogrid[:shape[0], :shape[1]]
+    return circle_mask(X, Y, center[0], center[1], radius)
+
 def mask_plot_from_image(data:np.ndarray, radius:float=31) -> np.ndarray:
     "Select only data from within field plot of radius (radius-1) pixels"
-    center = (int(data.shape[1]/2), int(data.shape[2]/2))
-    Y, X = np.ogrid[:data.shape[1], :data.shape[2]]
-    dist_from_center = np.sqrt((X-center[0])**2 + (Y-center[1])**2)
-    mask = dist_from_center <= radius
+    mask = plot_mask(data.shape[-2:], radius)
     data[:,~mask] = np.nan
     return data
 
@@ -58,40 +76,93 @@ def mask_plot_from_image(data:np.ndarray, radius:float=31) -> np.ndarray:
 
 # Cell
 
+image_metric_names = [f'{b}_pix_{s}' for b in ['nir', 'red', 'green', 'ndvi'] for s in ['max', 'min', 'mean', 'std', 'var']]
+
+def _image_stats(ims:np.ndarray) -> np.ndarray:
+    """Max, min, mean, std and var of NIR, red, green and NDVI of a stack of images (plots, bands, H, W) ignoring NaNs,
+    in a few reductions over the whole stack. Returns an array of shape (plots, 4, 5)"""
+    ims = np.concatenate((ims[:,:3], calc_normalized_spectral_index(np.moveaxis(ims, 1, 0), 0, 1)[:,None]), axis=1)
+    ims = ims.reshape(*ims.shape[:2], -1)
+    nan = np.isnan(ims)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vmax = np.where(nan, -np.inf, ims).max(axis=-1)
+        vmin = np.where(nan, np.inf, ims).min(axis=-1)
+        cnt = (~nan).sum(axis=-1)
+        zeroed = np.where(nan, 0, ims)
+        mean = zeroed.sum(axis=-1) / cnt
+        # Variance from the same centered moment as std, like `np.nanvar`
+        var = np.where(nan, 0, zeroed - mean[...,None].astype(ims.dtype))
+        var = (var * var).sum(axis=-1) / cnt
+    stats = np.stack((vmax, vmin, mean, np.sqrt(var), var), axis=-1).astype(ims.dtype)
+    stats[cnt == 0] = np.nan
+    return stats
+
+def batch_image_metrics(ims:np.ndarray, mask_plot:bool=True, radius:int=31, ids=None,
+                        id_col:str='sampleplotid') -> pd.DataFrame:
+    """`image_metrics` of a stack of NIR-red-green images (plots, bands, H, W) at once.
+    Returns a DataFrame with one row per plot and `image_metric_names` columns, preceded by `id_col` if `ids` are given"""
+    if mask_plot: ims = np.where(plot_mask(ims.shape[-2:], radius), ims, np.nan).astype(ims.dtype)
+    df = pd.DataFrame(_image_stats(ims).reshape(len(ims), -1), columns=image_metric_names)
+    if ids is not None: df.insert(0, id_col, ids)
+    return df
+
 def image_metrics(fn, mask_plot:bool=True, radius:int=31) -> dict:
-    "Calculate metrics from NIR-red-green -images"
-    image = open_geotiff(fn)
-    if mask_plot == True: image = mask_plot_from_image(image, radius=radius)
-    # Max, mean, std and coefficient of variation
-    features = {}
-    features['nir_pix_max'] = np.nanmax(image[0])
-    features['nir_pix_min'] = np.nanmin(image[0])
-    features['nir_pix_mean'] = np.nanmean(image[0])
-    features['nir_pix_std'] = np.nanstd(image[0])
-    features['nir_pix_var'] = np.nanvar(image[0])
-
-    features['red_pix_max'] = np.nanmax(image[1])
-    features['red_pix_min'] = np.nanmin(image[1])
-    features['red_pix_mean'] = np.nanmean(image[1])
-    features['red_pix_std'] = np.nanstd(image[1])
-    features['red_pix_var'] = np.nanvar(image[1])
-
-    features['green_pix_max'] = np.nanmax(image[2])
-    features['green_pix_min'] = np.nanmin(image[2])
-    features['green_pix_mean'] = np.nanmean(image[2])
-    features['green_pix_std'] = np.nanstd(image[2])
-    features['green_pix_var'] = np.nanvar(image[2])
-
-    # spectral indices
-    # NDVI
-    ndvi = calc_normalized_spectral_index(image, 0, 1)
-    features['ndvi_pix_max'] = np.nanmax(ndvi)
-    features['ndvi_pix_min'] = np.nanmin(ndvi)
-    features['ndvi_pix_mean'] = np.nanmean(ndvi)
-    features['ndvi_pix_std'] = np.nanstd(ndvi)
-    features['ndvi_pix_var'] = np.nanvar(ndvi)
+    "Calculate metrics from NIR-red-green -images. `fn` is either a path or an image opened with `open_geotiff`"
+    image = _as_image(fn)
+    with profile_stage('image_metrics', image.shape[-2] * image.shape[-1]):
+        if mask_plot == True: image = mask_plot_from_image(image.copy(), radius=radius)
+        return dict(zip(image_metric_names, _image_stats(image[None])[0].ravel()))
 
-    return features
+# Cell
+
+def quantize_grey_levels(im:np.ndarray, n_grey:int=20, mask:np.ndarray=None) -> tuple:
+    """Bin each image of `im` (..., H, W) to at most `n_grey` equal width grey levels between its minimum and maximum.
+    NaN pixels and pixels outside the boolean `mask` (broadcast to `im`) get level -1 and are ignored.
+    Returns the binned images and the number of levels of each image"""
+    valid = ~np.isnan(im) if mask is None else ~np.isnan(im) & np.broadcast_to(mask, im.shape)
+    flat, flat_valid = im.reshape(-1, *im.shape[-2:]), valid.reshape(-1, *im.shape[-2:])
+    binned = np.full(flat.shape, -1, dtype=np.int64)
+    n_levels = np.zeros(len(flat), dtype=np.int64)
+    for k, (x, v) in enumerate(zip(flat, flat_valid)):
+        x = x[v]
+        if len(x) == 0: continue
+        bins = np.linspace(x.min(), x.max(), min(n_grey, len(np.unique(x))) + 1)
+        binned[k][v] = np.digitize(x, bins) - 1
+        n_levels[k] = binned[k].max() + 1
+    return binned.reshape(im.shape), n_levels.reshape(im.shape[:-2])
+
+def _glcm_offset(distance:float, angle:float) -> tuple:
+    "Row and column offset of a pixel pair, rounded half away from zero like `greycomatrix`"
+    rnd = lambda v: int(np.sign(v) * np.floor(np.abs(v) + 0.5))
+    return rnd(np.sin(angle) * distance), rnd(np.cos(angle) * distance)
+
+def cooccurrence_matrix(binned:np.ndarray, distances:List[int], angles:List[float], levels:int,
+                        symmetric:bool=True, normed:bool=True) -> np.ndarray:
+    """Grey level co-occurrence matrices of a stack of binned images (..., H, W), same as `greycomatrix`.
+    Pixels with a level outside `[0, levels)`, like the -1 of `quantize_grey_levels`, are ignored.
+    The pixel pairs of all images, distances and angles are counted with a single `bincount`.
+    Returns an array of shape (..., levels, levels, distances, angles)"""
+    lead, (rows, cols) = binned.shape[:-2], binned.shape[-2:]
+    x = binned.reshape(-1, rows, cols)
+    n, n_d, n_a = len(x), len(distances), len(angles)
+    base = np.arange(n)[:,None,None] * levels
+    codes = []
+    for (d_idx, d), (a_idx, a) in product(enumerate(distances), enumerate(angles)):
+        dr, dc = _glcm_offset(d, a)
+        if abs(dr) >= rows or abs(dc) >= cols: continue
+        i = x[:, max(0, -dr):rows - max(0, dr), max(0, -dc):cols - max(0, dc)]
+        j = x[:, max(0, dr):rows - max(0, -dr), max(0, dc):cols - max(0, -dc)]
+        valid = (i >= 0) & (i < levels) & (j >= 0) & (j < levels)
+        codes.append((((base + i) * levels + j) * n_d + d_idx)[valid] * n_a + a_idx)
+    codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+    P = np.bincount(codes, minlength=n*levels*levels*n_d*n_a).reshape(n, levels, levels, n_d, n_a)
+    if symmetric: P = P + P.transpose(0, 2, 1, 3, 4)
+    if normed:
+        P = P.astype(np.float64)
+        sums = P.sum(axis=(1,2), keepdims=True)
+        sums[sums == 0] = 1
+        P /= sums
+    return P.reshape(*lead, levels, levels, n_d, n_a)
 
 # Cell
 
@@ -113,148 +184,362 @@ def glcm_xminusy(glcm, k, distance, angle):
     if k == 0: return s
     return s*2
 
-def textural_features(fn,
-                      band_names:List=['nir', 'red', 'green', 'ndvi'],
-                      distances:List[int]=[8],
-                      angles:List[float]=[0, np.pi/4, np.pi/2, 3*np.pi/4],
-                      n_grey:int=20) -> dict:
-    """Get textural features from images. Works close to R package radiomics `GLCMFeatures` functions.
-    However skimage makes glcm a bit differently"""
+def _glcm_bincount(glcm:np.ndarray, idx:np.ndarray, length:int) -> np.ndarray:
+    "Sum `glcm` of shape (levels, levels, ...) over cells with the same `idx`, for all distances and angles"
+    n_da = int(np.prod(glcm.shape[2:]))
+    flat = (idx.reshape(-1, 1) * n_da + np.arange(n_da)).ravel()
+    sums = np.bincount(flat, weights=glcm.reshape(-1, n_da).ravel(), minlength=length*n_da)
+    return sums.reshape(length, *glcm.shape[2:])
+
+def _plogp(p:np.ndarray, axis:int=0) -> np.ndarray:
+    "Sum of `p * log2(p)` over the non-zero elements of `p` along `axis`"
+    return np.sum(np.where(p > 0, p * np.log2(np.where(p > 0, p, 1)), 0), axis=axis)
+
+def _value_entropy(glcm:np.ndarray) -> np.ndarray:
+    "`skimage.measure.shannon_entropy` of each (levels, levels) matrix of `glcm`, i.e. entropy of the distinct values"
+    s = np.sort(glcm.reshape(-1, int(np.prod(glcm.shape[2:]))), axis=0)
+    n = len(s)
+    start = np.ones(s.shape, dtype=bool)
+    start[1:] = s[1:] != s[:-1]
+    # Runs of equal values, column by column
+    pos = np.flatnonzero(start.T.ravel())
+    p = np.diff(np.append(pos, start.size)) / n
+    return -np.bincount(pos // n, weights=p * np.log2(p), minlength=s.shape[1]).reshape(glcm.shape[2:])
+
+def glcm_features(glcm:np.ndarray) -> dict:
+    """Calculate the `textural_features` of a normalized, symmetric `glcm` of shape (levels, levels, distances, angles)
+    for all distances and angles at once. Any further trailing dimensions, e.g. windows, are computed at once as well.
+    Returns a dict of `glcm_feature_names` arrays of shape `glcm.shape[2:]`.
+    Cluster shade and autocorrelation use the first distance for all distances, like the original implementation"""
+    n_levels, ext = glcm.shape[0], (1,) * (glcm.ndim - 2)
+    i, j = np.ogrid[:n_levels, :n_levels]
+    i4, j4 = i.reshape(n_levels, 1, *ext), j.reshape(1, n_levels, *ext)
+    diff = np.abs(i - j)
+    # Features with weights that depend only on the levels are contracted over the levels with BLAS
+    wsum = lambda w, p=glcm: np.tensordot(w, p, axes=((0,1),(0,1)))
+    f = {}
+    f['mean'] = np.sum(glcm.sum(axis=1) * np.arange(1, n_levels+1).reshape(n_levels, *ext), axis=0)
+    f['var'] = np.sum((i4 - f['mean'])**2 * glcm, axis=(0,1))
+    cluster = i4 + j4 - 2*f['mean']
+    cluster2 = cluster * cluster
+    f['cProminence'] = np.sum(cluster2 * cluster2 * glcm, axis=(0,1))
+    f['cShade'] = np.sum(cluster2 * cluster * glcm[:,:,:1], axis=(0,1))
+    f['cTendency'] = np.sum(cluster2 * glcm, axis=(0,1))
+    f['ac'] = np.broadcast_to(wsum((i+1) * (j+1), glcm[:,:,:1]), glcm.shape[2:])
+    f['homogeneity1'] = wsum(1 / (1 + diff))
+    f['idmn'] = wsum(1 / (1 + diff**2 / n_levels**2))
+    f['idn'] = wsum(1 / (1 + diff / n_levels))
+    f['iv'] = wsum(np.where(diff > 0, 1 / np.maximum(diff, 1)**2, 0))
+    # p_{x-y} from the lower triangle, doubled off the diagonal, and p_{x+y}
+    p_minus = _glcm_bincount(glcm * (i4 >= j4), np.maximum(i - j, 0), n_levels)
+    p_minus[1:] *= 2
+    p_plus = _glcm_bincount(glcm, i + j, 2*n_levels - 1)
+    k = np.arange(2*n_levels - 1).reshape(-1, *ext)
+    f['diffentropy'] = -_plogp(p_minus[:n_levels-1])
+    f['energy'] = np.sum(glcm**2, axis=(0,1))
+    f['ent'] = _value_entropy(glcm)
+    f['sumaverage'] = np.sum((k + 2) * p_plus, axis=0)
+    f['sumentropy'] = -_plogp(p_plus)
+    f['sumvariance'] = np.sum((k[:-1] + 3 - f['sumentropy'])**2 * p_plus[:-1], axis=0)
+    f['contrast'] = wsum(diff**2)
+    f['dissimilarity'] = wsum(diff)
+    f['homogeneity2'] = wsum(1 / (1 + diff**2))
+    # correlation as in `greycoprops`, 1 for constant images
+    mean_i, mean_j = wsum(np.broadcast_to(i, diff.shape)), wsum(np.broadcast_to(j, diff.shape))
+    std_i = np.sqrt(np.sum(glcm * (i4 - mean_i)**2, axis=(0,1)))
+    std_j = np.sqrt(np.sum(glcm * (j4 - mean_j)**2, axis=(0,1)))
+    cov = np.sum(glcm * (i4 - mean_i) * (j4 - mean_j), axis=(0,1))
+    const = (std_i < 1e-15) | (std_j < 1e-15)
+    f['corr'] = np.where(const, 1., cov / np.where(const, 1., std_i * std_j))
+    f['maxProb'] = glcm.max(axis=(0,1))
+    return f
+
+glcm_feature_names = ['mean', 'var', 'ac', 'cProminence', 'cShade', 'cTendency', 'contrast', 'corr', 'diffentropy',
+                      'dissimilarity', 'energy', 'ent', 'homogeneity1', 'homogeneity2', 'idmn', 'idn', 'iv', 'maxProb',
+                      'sumaverage', 'sumentropy', 'sumvariance']
+
+def _band_textures(glcm:np.ndarray, n_levels:np.ndarray, band_names:List) -> dict:
+    "Average `glcm_features` over distances and angles for each band of `glcm` (bands, levels, levels, distances, angles)"
     tex_features = {}
-    im = open_geotiff(fn)
-
-    # add NDVI
-    im = np.vstack((im, calc_normalized_spectral_index(im, 1, 0)[None]))
-
-    for b in range(im.shape[0]):
-        pref = band_names[b]
-
-        # bin image to at maximum n_grey levels
-        bins = np.linspace(im[b].min(),im[b].max(), min(n_grey, len(np.unique(im[b]))) + 1)
-        binned_im = np.digitize(im[b], bins) - 1
-
-        n_levels = binned_im.max() + 1
-        # get glcm. Note that skimage makes glcm differently than radiomics
-        glcm = greycomatrix(binned_im,
-                            distances=distances,
-                            angles=angles,
-                            levels=n_levels,
-                            normed=True, symmetric=True)
-
-        # greycoprops gives some features easily
-        # Others not so much
-        means = np.zeros((len(distances), len(angles)))
-        variances = np.zeros((len(distances), len(angles)))
-        autocorrelations = np.zeros((len(distances), len(angles)))
-        cluster_prominences = np.zeros((len(distances), len(angles)))
-        cluster_shades = np.zeros((len(distances), len(angles)))
-        cluster_tendencies = np.zeros((len(distances), len(angles)))
-        diff_entropies = np.zeros((len(distances), len(angles)))
-        energies = np.zeros((len(distances), len(angles)))
-        entropies = np.zeros((len(distances), len(angles)))
-        hgn1s = np.zeros((len(distances), len(angles)))
-        idmns = np.zeros((len(distances), len(angles)))
-        idns = np.zeros((len(distances), len(angles)))
-        inverse_variances = np.zeros((len(distances), len(angles)))
-        sum_averages = np.zeros((len(distances), len(angles)))
-        sum_entropies = np.zeros((len(distances), len(angles)))
-        sum_variances = np.zeros((len(distances), len(angles)))
-
-        # Todo chech that multiple distances work
-        for d,a in product(range(len(distances)), range(len(angles))):
-            # means
-            means[d,a] = np.sum(np.sum(glcm[:,:,d,a], axis=1) * np.arange(1,n_levels+1))
-
-            scale_matrix = np.empty((n_levels, n_levels))
-
-            for i, j in product(range(n_levels), range(n_levels)):
-                # variance
-                variances[d,a] += (((i) - means[d,a])**2) * glcm[i,j,d,a]
-
-                # cluster metrix
-                cluster_prominences[d,a] += ((i + j - 2*means[d,a])**4) * glcm[i,j,d,a]
-                cluster_shades[d,a] += ((i+j - 2*means[d,a])**3)*glcm[i,j,0,a]
-                cluster_tendencies[d,a] += ((i + j - 2 * means[d,a])**2) * glcm[i,j,d,a]
-
-                # scale matrix for autocorrelations
-                scale_matrix[i,j] = (i+1) * (j+1)
-
-                # homogeneity 1
-                hgn1s[d,a] += glcm[i,j,d,a] / (1 + (np.abs(i-j)))
-
-                # IDM normalized
-                idmns[d,a] += glcm[i,j,d,a] / (1 + ((np.abs(i-j)**2)/(n_levels)**2))
-
-                # ID normalized
-                idns[d,a] += glcm[i,j,d,a] / (1 + (np.abs(i-j)/n_levels))
-
-                # Inverse variance
-                if i != j: inverse_variances[d,a] += glcm[i,j,d,a] / np.abs(i-j)**2
-
-            # autocorrelations
-            autocorrelations[d,a] = np.sum(glcm[:,:,0,a]*scale_matrix)
-
-            # diff_entropy
-            for i in range(n_levels-1):
-                pxy = glcm_xminusy(glcm, k=i, distance=d, angle=a)
-                if pxy > 0: diff_entropies[d,a] += pxy * np.log2(pxy)
-            diff_entropies[d,a] *= -1
-
-            # energy
-            energies[d,a] = np.sum(np.square(glcm[...,d,a]))
-
-            # entropy
-            entropies[d,a] = skimage.measure.shannon_entropy(glcm[...,d,a])
-
-            for i in range(2*(n_levels)-1):
-                # sum averages
-                pxy = glcm_xplusy(glcm, k=i, distance=d, angle=a)
-                sum_averages[d,a] += (i+2) * pxy
-
-                # sum entropies
-                if pxy > 0: sum_entropies[d,a] += pxy * np.log2(pxy)
-
-            sum_entropies[d,a] *= -1
-
-            for i in range(2*(n_levels) - 1):
-                # sum variances
-                pxy = glcm_xplusy(glcm, k=i-1, distance=d, angle=a)
-                sum_variances[d,a] += ((i+2 - sum_entropies[d,a])**2) * pxy
-
+    for b, pref in enumerate(band_names[:len(glcm)]):
+        # Levels above the band's own maximum are empty, drop them so that the features match a band-wise glcm
+        f = glcm_features(glcm[b, :n_levels[b], :n_levels[b]])
         # Average all the angles
-        tex_features[f'{pref}_mean'] = np.mean(means)
-        tex_features[f'{pref}_var'] = np.mean(variances)
-        tex_features[f'{pref}_ac'] = np.mean(autocorrelations)
-        tex_features[f'{pref}_cProminence'] = np.mean(cluster_prominences)
-        tex_features[f'{pref}_cShade'] = np.mean(cluster_shades)
-        tex_features[f'{pref}_cTendency'] = np.mean(cluster_tendencies)
-        tex_features[f'{pref}_contrast'] = np.mean(greycoprops(glcm, 'contrast'))
-        tex_features[f'{pref}_corr'] = np.mean(greycoprops(glcm, 'correlation'))
-        tex_features[f'{pref}_diffentropy'] = np.mean(diff_entropies)
-        tex_features[f'{pref}_dissimilarity'] = np.mean(greycoprops(glcm, 'dissimilarity'))
-        tex_features[f'{pref}_energy'] = np.mean(energies)
-        tex_features[f'{pref}_ent'] = np.mean(entropies)
-        tex_features[f'{pref}_homogeneity1'] = np.mean(hgn1s)
-        tex_features[f'{pref}_homogeneity2'] = np.mean(greycoprops(glcm, 'homogeneity'))
-        tex_features[f'{pref}_idmn'] = np.mean(idmns)
-        tex_features[f'{pref}_idn'] = np.mean(idns)
-        tex_features[f'{pref}_iv'] = np.mean(inverse_variances)
-        tex_features[f'{pref}_maxProb'] = np.mean(glcm.max(axis=(0,1)))
-        tex_features[f'{pref}_sumaverage'] = np.mean(sum_averages)
-        tex_features[f'{pref}_sumentropy'] = np.mean(sum_entropies)
-        tex_features[f'{pref}_sumvariance'] = np.mean(sum_variances)
+        tex_features.update({f'{pref}_{k}': np.mean(f[k]) for k in glcm_feature_names})
 
         # Information measures of correlation TODO
         #tex_features[f'{pref}_icm1'] = None
         #tex_features[f'{pref}_icm2'] = None
-
     return tex_features
 
+def _add_ndvi(im:np.ndarray) -> np.ndarray:
+    "Add NDVI as the last band of images (..., C, H, W)"
+    return np.concatenate((im, calc_normalized_spectral_index(np.moveaxis(im, -3, 0), 1, 0)[...,None,:,:]), axis=-3)
+
+def textural_features(fn,
+                      band_names:List=['nir', 'red', 'green', 'ndvi'],
+                      distances:List[int]=[8],
+                      angles:List[float]=[0, np.pi/4, np.pi/2, 3*np.pi/4],
+                      n_grey:int=20, mask_plot:bool=False, radius:int=31) -> dict:
+    """Get textural features from images. Works close to R package radiomics `GLCMFeatures` functions.
+    However skimage makes glcm a bit differently. `fn` is either a path or an image opened with `open_geotiff`.
+    With `mask_plot`, only pixels within the field plot of `radius` pixels are used"""
+    im = _as_image(fn)
+    with profile_stage('textural_features', im.shape[-2] * im.shape[-1]):
+        im = _add_ndvi(im)
+        mask = plot_mask(im.shape[-2:], radius) if mask_plot else None
+        binned, n_levels = quantize_grey_levels(im, n_grey, mask)
+        glcm = cooccurrence_matrix(binned, distances, angles, levels=max(n_levels.max(), 1))
+        return _band_textures(glcm, n_levels, band_names)
+
+def stack_textural_features(ims:np.ndarray,
+                            band_names:List=['nir', 'red', 'green', 'ndvi'],
+                            distances:List[int]=[8],
+                            angles:List[float]=[0, np.pi/4, np.pi/2, 3*np.pi/4],
+                            n_grey:int=20, mask_plot:bool=False, radius:int=31) -> List[dict]:
+    "`textural_features` for a stack of same sized images (N, C, H, W), with the co-occurrences of all of them counted at once"
+    ims = _add_ndvi(ims)
+    mask = plot_mask(ims.shape[-2:], radius) if mask_plot else None
+    binned, n_levels = quantize_grey_levels(ims, n_grey, mask)
+    glcm = cooccurrence_matrix(binned, distances, angles, levels=max(n_levels.max(), 1))
+    return [_band_textures(g, nl, band_names) for g, nl in zip(glcm, n_levels)]
+
 # Cell
 
-def process_image_features(fn:str, mask_plot:bool=True, radius:int=31):
-    "Process rasters to tabular format. Todo Textural features parasm"
-    image_features = image_metrics(fn, mask_plot=mask_plot, radius=radius)
-    texture_features = textural_features(fn)
+def process_image_features(fn:str, mask_plot:bool=True, radius:int=31, mask_textures:bool=False):
+    """Process rasters to tabular format. The raster is opened only once. Todo Textural features parasm
+    Textures use the whole image unless `mask_textures`, to keep the features of earlier runs"""
+    image = _as_image(fn)
+    image_features = image_metrics(image, mask_plot=mask_plot, radius=radius)
+    texture_features = textural_features(image, mask_plot=mask_textures, radius=radius)
     features = {**image_features, **texture_features}
-    return features
\ No newline at end of file
+    return features
+
+# Cell
+
+def _window_blocks(f, window:rio.windows.Window) -> list:
+    "`(row, col)` indices of the internal blocks of raster `f` that `window` overlaps"
+    bh, bw = f.block_shapes[0]
+    r0, c0 = max(window.row_off, 0), max(window.col_off, 0)
+    r1, c1 = min(window.row_off + window.height, f.height), min(window.col_off + window.width, f.width)
+    if r1 <= r0 or c1 <= c0: return []
+    return list(product(range(r0 // bh, (r1 - 1) // bh + 1), range(c0 // bw, (c1 - 1) // bw + 1)))
+
+def _paste_block(im:np.ndarray, window:rio.windows.Window, block:np.ndarray, block_window:rio.windows.Window):
+    "Copy the part of `block` read from `block_window` that overlaps `window` to `im` read from `window`"
+    r0, c0 = max(window.row_off, block_window.row_off), max(window.col_off, block_window.col_off)
+    r1 = min(window.row_off + window.height, block_window.row_off + block_window.height)
+    c1 = min(window.col_off + window.width, block_window.col_off + block_window.width)
+    im[:, r0-window.row_off:r1-window.row_off, c0-window.col_off:c1-window.col_off] = \
+        block[:, r0-block_window.row_off:r1-block_window.row_off, c0-block_window.col_off:c1-block_window.col_off]
+
+def iter_plot_windows(fn, plots:pd.DataFrame, size:int=61, x_col:str='x', y_col:str='y',
+                      id_col:str='sampleplotid', bands:List[int]=None):
+    """Yield `(plot_id, image)` for each plot center of `plots` from a large raster `fn`.
+    Each image is a `size` times `size` pixel window centered on the plot, scaled like in `open_geotiff`,
+    and areas outside the raster are zeros. Plots are visited in raster order of the internal block containing
+    their center, and the windows are built from the blocks they overlap. Each block is read once and kept
+    only until the last window that needs it is built"""
+    half = size // 2
+    with rio.open(str(fn)) as f:
+        rows, cols = rio.transform.rowcol(f.transform, plots[x_col].values, plots[y_col].values)
+        rows, cols = np.asarray(rows) - half, np.asarray(cols) - half
+        bh, bw = f.block_shapes[0]
+        keys = (rows + half) // bh * (f.width // bw + 1) + (cols + half) // bw
+        order = np.argsort(keys, kind='stable')
+        windows = [rio.windows.Window(cols[i], rows[i], size, size) for i in range(len(plots))]
+        needed = [_window_blocks(f, windows[i]) for i in order]
+        last_use = {b:n for n, blocks in enumerate(needed) for b in blocks}
+        indexes = list(range(1, f.count+1)) if bands is None else [b+1 for b in bands]
+        ids, cache = plots[id_col].values, {}
+        for n, (i, blocks) in enumerate(zip(order, needed)):
+            im = np.zeros((len(indexes), size, size), dtype=np.float32)
+            for b in blocks:
+                if b not in cache:
+                    bwin = f.block_window(1, *b)
+                    cache[b] = (f.read(indexes, window=bwin), bwin)
+                _paste_block(im, windows[i], *cache[b])
+                if last_use[b] == n: del cache[b]
+            im /= 255.
+            yield ids[i], im
+
+def plot_window_features(fn, plots:pd.DataFrame, size:int=61, x_col:str='x', y_col:str='y',
+                         id_col:str='sampleplotid', mask_plot:bool=True, radius:int=31,
+                         chunk_size:int=256) -> pd.DataFrame:
+    """Calculate `process_image_features` for plots of `plots` directly from windows of a large raster `fn`.
+    Windows are processed in stacks of `chunk_size` plots with `batch_image_metrics` and `stack_textural_features`"""
+    windows = iter_plot_windows(fn, plots, size=size, x_col=x_col, y_col=y_col, id_col=id_col)
+    dfs = []
+    for chunk in iter(lambda: list(islice(windows, chunk_size)), []):
+        ids, ims = zip(*chunk)
+        ims = np.stack(ims)
+        tex = pd.DataFrame(stack_textural_features(ims))
+        dfs.append(pd.concat((batch_image_metrics(ims, mask_plot=mask_plot, radius=radius, ids=ids, id_col=id_col), tex), axis=1))
+    df = pd.concat(dfs, ignore_index=True).drop_duplicates(id_col).set_index(id_col)
+    return df.reindex(plots[id_col].unique()).rename_axis(id_col).reset_index()
+
+# Cell
+
+def _quantize_fixed(im:np.ndarray, n_grey:int, ranges:List[tuple]) -> np.ndarray:
+    "Bin bands of `im` (C, H, W) to `n_grey` equal width levels within fixed value `ranges`, NaN pixels to -1"
+    lo, hi = [np.array(r, dtype=np.float64)[:,None,None] for r in zip(*ranges)]
+    binned = np.clip(np.floor((im - lo) / (hi - lo) * n_grey), 0, n_grey - 1)
+    return np.where(np.isnan(im), -1, binned).astype(np.int64)
+
+class _SlidingWindows():
+    """Co-occurrence counts and band sums of a row of `window` sized windows, `step` pixels apart, in a strip `q`/`v`.
+    Windows are moved down `step` rows at a time by removing the pixel rows that leave the windows and
+    adding the ones that enter, instead of counting each window from scratch"""
+    def __init__(self, q:np.ndarray, v:np.ndarray, n_win:int, window:int, step:int, offsets:list, levels:int):
+        self.q, self.v, self.window, self.step, self.offsets, self.levels = q, v, window, step, offsets, levels
+        self.n_win, self.cols = n_win, np.arange(n_win)[:,None] * step
+        self.hist = np.zeros((len(offsets), len(q), n_win, levels, levels), dtype=np.int64)
+        self.cnt, self.s, self.s2 = [np.zeros((len(v), v.shape[-1])) for _ in range(3)]
+        self.top = None
+
+    def _pairs(self, o:int, r0:int, r1:int, sign:int):
+        "Add `sign` times the pairs of offset `o` with first pixel on rows `r0:r1` to the windows containing them"
+        dr, dc = self.offsets[o]
+        if r1 <= r0: return
+        cols = self.cols + max(0, -dc) + np.arange(self.window - abs(dc))
+        i, j = self.q[:, r0:r1][:,:,cols], self.q[:, r0+dr:r1+dr][:,:,cols+dc]
+        valid = (i >= 0) & (j >= 0)
+        code = ((np.arange(len(self.q))[:,None,None,None] * self.n_win + np.arange(self.n_win)[:,None]) * self.levels + i) * self.levels + j
+        counts = np.bincount(code[valid], minlength=self.hist[o].size).reshape(self.hist[o].shape)
+        self.hist[o] += sign * counts
+
+    def _rows(self, r0:int, r1:int, sign:int):
+        "Add `sign` times the band values of rows `r0:r1` to the column sums"
+        if r1 <= r0: return
+        v = self.v[:, r0:r1]
+        ok = ~np.isnan(v)
+        v = np.where(ok, v, 0)
+        self.cnt += sign * ok.sum(axis=1)
+        self.s += sign * v.sum(axis=1)
+        self.s2 += sign * (v**2).sum(axis=1)
+
+    def move_to(self, top:int):
+        "Move the windows to start at row `top`, updating only the rows that differ from the current position"
+        w = self.window
+        for o, (dr, dc) in enumerate(self.offsets):
+            a, b = max(0, -dr), w - max(0, dr)
+            if self.top is None or top - self.top >= b - a:
+                if self.top is not None: self.hist[o] = 0
+                self._pairs(o, top + a, top + b, 1)
+            else:
+                self._pairs(o, self.top + a, top + a, -1)
+                self._pairs(o, self.top + b, top + b, 1)
+        if self.top is None or top - self.top >= w:
+            for arr in (self.cnt, self.s, self.s2): arr[:] = 0
+            self._rows(top, top + w, 1)
+        else:
+            self._rows(self.top, top, -1)
+            self._rows(self.top + w, top + w, 1)
+        self.top = top
+
+    def textures(self, n_d:int, n_a:int) -> np.ndarray:
+        "Features of `glcm_feature_names` for each band and window averaged over distances and angles, (bands, features, windows)"
+        P = self.hist.reshape(n_d, n_a, *self.hist.shape[1:]).astype(np.float64)
+        P = np.moveaxis(P + np.swapaxes(P, -1, -2), (-2, -1), (0, 1))  # (L, L, D, A, bands, windows)
+        sums = P.sum(axis=(0,1))
+        P /= np.where(sums == 0, 1, sums)
+        f = glcm_features(P)
+        out = np.stack([f[k].mean(axis=(0,1)) for k in glcm_feature_names], axis=1)
+        out[np.broadcast_to((sums == 0).all(axis=(0,1))[:,None], out.shape)] = np.nan
+        return out
+
+    def spectral(self) -> np.ndarray:
+        "Max, min, mean, std and var of each band and window, (bands, 5, windows)"
+        w, cols = self.window, self.cols + np.arange(self.window)
+        v = self.v[:, self.top:self.top+w]
+        vmax = np.where(np.isnan(v), -np.inf, v).max(axis=1)[:, cols].max(axis=-1)
+        vmin = np.where(np.isnan(v), np.inf, v).min(axis=1)[:, cols].min(axis=-1)
+        win_sum = lambda a: np.diff(np.concatenate((np.zeros((len(a), 1)), a.cumsum(axis=1)), axis=1)[:, self.cols[:,0][:,None] + [0, w]], axis=-1)[...,0]
+        n = win_sum(self.cnt)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = win_sum(self.s) / n
+            var = np.maximum(win_sum(self.s2) / n - mean**2, 0)
+        out = np.stack((vmax, vmin, mean, np.sqrt(var), var), axis=1)
+        out[np.broadcast_to((n == 0)[:,None], out.shape)] = np.nan
+        return out
+
+def feature_map(fn, outfile, window:int=61, step:int=10, spectral:bool=True, textures:bool=True,
+                band_names:List=['nir', 'red', 'green', 'ndvi'], distances:List[int]=[8],
+                angles:List[float]=[0, np.pi/4, np.pi/2, 3*np.pi/4], n_grey:int=20,
+                ranges:List[tuple]=[(0, 1), (0, 1), (0, 1), (-1, 1)], block_rows:int=16) -> List[str]:
+    """Compute `image_metrics` and `textural_features` on a moving `window` (odd, pixels) over a whole NIR-red-green
+    raster `fn` and write them to the multi-band GeoTIFF `outfile`, one output pixel per `step` times `step` pixels,
+    with the window centered on it. The raster is read in strips of `block_rows` output rows with overlap halos and
+    the output is written strip by strip. Within a strip, co-occurrences and band sums are updated as the windows slide.
+    Grey levels are fixed per band by `ranges` instead of the window's own minimum and maximum, which makes
+    the incremental updates possible. Windows are square and not masked. Returns the band names"""
+    assert window % 2 == 1, 'window must be odd'
+    half = window // 2
+    offsets = [_glcm_offset(d, a) for d, a in product(distances, angles)]
+    names = (image_metric_names if spectral else []) + ([f'{b}_{k}' for b in band_names for k in glcm_feature_names] if textures else [])
+    with rio.open(str(fn)) as src:
+        n_rows, n_cols = -(-src.height // step), -(-src.width // step)
+        profile = dict(driver='GTiff', height=n_rows, width=n_cols, count=len(names), dtype='float32', crs=src.crs,
+                       transform=src.transform * rio.Affine.scale(step), nodata=np.nan, compress='deflate')
+        with rio.open(str(outfile), 'w', **profile) as dst:
+            for b, name in enumerate(names): dst.set_band_description(b+1, name)
+            for k0 in range(0, n_rows, block_rows):
+                k1 = min(k0 + block_rows, n_rows)
+                strip = rio.windows.Window(step//2 - half, k0*step + step//2 - half, (n_cols-1)*step + window,
+                                           (k1-k0-1)*step + window)
+                im = src.read([1, 2, 3], window=strip, boundless=True, masked=True).astype(np.float64).filled(np.nan) / 255.
+                v = np.concatenate((im, calc_normalized_spectral_index(im, 0, 1)[None]))
+                q = _quantize_fixed(_add_ndvi(im), n_grey, ranges)
+                sw = _SlidingWindows(q if textures else q[:0], v if spectral else v[:0], n_cols, window, step, offsets, n_grey)
+                out = np.full((len(names), k1-k0, n_cols), np.nan, dtype=np.float32)
+                for m in range(k1 - k0):
+                    sw.move_to(m * step)
+                    feats = ([sw.spectral().reshape(-1, n_cols)] if spectral else []) + \
+                            ([sw.textures(len(distances), len(angles)).reshape(-1, n_cols)] if textures else [])
+                    out[:, m] = np.concatenate(feats)
+                dst.write(out, window=rio.windows.Window(0, k0, n_cols, k1-k0))
+    return names
+
+# Cell
+
+def spectral_index_funcs(nir:int=0, red:int=1, green:int=2) -> dict:
+    "Spectral index functions of `spectral_index_raster` by name, for images with bands `nir`, `red` and `green`"
+    return {'ndvi': partial(calc_normalized_spectral_index, band_1=nir, band_2=red),
+            'avi': partial(calc_avi, nir=nir, red=red),
+            'savi': partial(calc_savi, nir=nir, red=red),
+            'gci': partial(calc_gci, nir=nir, green=green)}
+
+def spectral_index_raster(fn, outfile, indices:List[str]=['ndvi', 'savi', 'gci'], nir:int=0, red:int=1, green:int=2,
+                          n_workers:int=None, blocksize:int=512) -> None:
+    """Write spectral `indices` of a NIR-red-green raster `fn` to a tiled, compressed float32 GeoTIFF `outfile`, one band
+    per index. The raster is processed block by block: each block is read as uint8, scaled to 0-1 like `open_geotiff`
+    and the indices are computed on it, so only a few blocks are in memory at a time. Blocks are processed on a pool
+    of `n_workers` threads, each with its own reader, as rasterio releases the GIL during reads and writes"""
+    funcs = spectral_index_funcs(nir, red, green)
+    funcs = [funcs[i] for i in indices]
+    bands = sorted({nir, red, green})
+    local, readers = threading.local(), []
+    with rio.open(str(fn)) as src:
+        profile = dict(driver='GTiff', height=src.height, width=src.width, count=len(indices), dtype='float32',
+                       crs=src.crs, transform=src.transform, nodata=np.nan, tiled=True, blockxsize=blocksize,
+                       blockysize=blocksize, compress='deflate', predictor=3)
+    write_lock = threading.Lock()
+    with rio.open(str(outfile), 'w', **profile) as dst:
+        for b, name in enumerate(indices): dst.set_band_description(b+1, name)
+
+        def _process(window):
+            if not hasattr(local, 'src'):
+                local.src = rio.open(str(fn))
+                readers.append(local.src)
+            data = local.src.read([b+1 for b in bands], window=window, masked=True)
+            im = np.zeros((max(bands)+1, *data.shape[1:]), dtype=np.float32)
+            im[bands] = data.astype(np.float32).filled(np.nan) / 255.
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out = np.stack([f(im) for f in funcs]).astype(np.float32)
+            with write_lock: dst.write(out, window=window)
+
+        windows = [w for _, w in dst.block_windows(1)]
+        try:
+            with ThreadPoolExecutor(max_workers=n_workers) as ex: list(ex.map(_process, windows))
+        finally:
+            for r in readers: r.close()
\ No newline at end of file
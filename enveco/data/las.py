@@ -1,11 +1,14 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01_data.las.ipynb (unless otherwise specified).
 
-__all__ = ['plot_point_cloud', 'plot_2d_views', 'las_to_df', 'mask_plot_from_lidar', 'normalized_shannon_entropy',
-           'height_metrics', 'z_stats', 'z_percentages', 'z_quantiles', 'z_cumul', 'z_stat_cols', 'z_pct_cols',
-           'z_quant_cols', 'z_cumul_cols', 'z_cols', 'intensity_metrics', 'i_stats', 'i_cumul_zq', 'i_stat_cols',
-           'i_qumul_zq_cols', 'i_cols', 'class_metrics', 'class_cols', 'density_metrics', 'density_cols',
-           'point_cloud_metrics', 'point_cloud_metric_cols', 'VoxelImage', 'get_las_data', 'get_3d_grid', 'VoxelBlock',
-           'LasColReader', 'VoxelDataLoaders', 'lastile_to_df']
+__all__ = ['plot_point_cloud', 'plot_2d_views', 'PointCloud', 'las_to_df', 'mask_plot_from_lidar', 'PlotIndex',
+           'las_dims', 'normalized_shannon_entropy', 'HeightSketch', 'height_metrics', 'z_stats', 'z_percentages',
+           'z_quantiles', 'z_cumul', 'z_stat_cols', 'z_pct_cols', 'z_quant_cols', 'z_cumul_cols', 'z_cols',
+           'intensity_metrics', 'i_stats', 'i_cumul_zq', 'i_stat_cols', 'i_qumul_zq_cols', 'i_cols', 'class_metrics',
+           'class_cols', 'density_metrics', 'density_cols', 'stdmetrics', 'point_cloud_metrics',
+           'point_cloud_metric_cols', 'voxel_counts', 'fill_bottom_voxels', 'SparseVoxels', 'VoxelImage',
+           'get_las_data', 'get_3d_grid', 'VoxelBlock', 'VoxelDihedral', 'LasColReader', 'densify_voxels',
+           'sparse_collate', 'VoxelStore', 'VoxelDataLoaders', 'grid_metrics', 'lastile_to_df', 'grid_to_raster',
+           'lastile_to_raster', 'iter_las_chunks', 'PointCloudStats', 'stream_grid_metrics', 'stream_plot_metrics']
 
 # Cell
 import laspy
@@ -14,7 +17,12 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from itertools import product
+from copy import deepcopy
+import json
 from scipy.stats import skew, kurtosis, entropy
+import rasterio as rio
+from .image import circle_mask
+from ..profiling import profile_stage
 
 # Cell
 def plot_point_cloud(lasfile:laspy.file.File, **kwargs) -> plt.Axes:
@@ -64,29 +72,100 @@ def plot_2d_views(lasfile:laspy.file.File)-> plt.Axes:
 
 # Cell
 
-def las_to_df(fn:str) -> pd.DataFrame:
-    """Open .las-file and return it as dataframe with columns [x, y, z, num_returns, intensity].
-    Also convert point cloud to photogrammetric, meaning only one z-coordinate in each x-y -pair"""
-    lasfile = laspy.file.File(fn, mode='r')
-    lidar_df = pd.DataFrame(columns=['x', 'y', 'z', 'num_returns', 'return_num', 'scan_angle_rank', 'intensity'],
-                            data=np.dstack((lasfile.x,
-                                            lasfile.y,
-                                            lasfile.z,
-                                            lasfile.num_returns,
-                                            lasfile.return_num,
-                                            lasfile.scan_angle_rank,
-                                            lasfile.intensity))[0])
-    # Make sure we only have one value for each x,y -point (photogrammetric point cloud)
-    #lidar_df = lidar_df.drop_duplicates(['x','y'], keep='last')
-    lasfile.close()
-    return lidar_df
+las_dims = ['x', 'y', 'z', 'num_returns', 'return_num', 'scan_angle_rank', 'intensity']
+_scaled_dims = {'x':('X', 0), 'y':('Y', 1), 'z':('Z', 2)}
+
+class PointCloud():
+    """Columnar point cloud. Dimensions are kept in their native dtypes, and `x`, `y` and `z` are stored as raw
+    integers and scaled with header scale and offset only when accessed. Supports `pc.z`, `pc['z']`,
+    `len(pc)` and row selection with `pc[mask]`, so it can be used in place of dataframes from `las_to_df`"""
+    def __init__(self, cols:dict, scale=(1.,1.,1.), offset=(0.,0.,0.)):
+        self.cols, self.scale, self.offset = cols, tuple(scale), tuple(offset)
+
+    @classmethod
+    def from_las(cls, fn, dims:list=las_dims):
+        """Read only `dims` from .las-file. Uncompressed files are memory-mapped by laspy,
+        so only the requested dimensions are copied out of the point records"""
+        with profile_stage('las_read') as st:
+            lasfile = laspy.file.File(str(fn), mode='r')
+            cols = {d: np.array(getattr(lasfile, _scaled_dims[d][0] if d in _scaled_dims else d)) for d in dims}
+            scale, offset = lasfile.header.scale, lasfile.header.offset
+            lasfile.close()
+            st.n = len(cols[dims[0]]) if dims else None
+        return cls(cols, scale, offset)
+
+    @property
+    def dims(self): return list(self.cols.keys())
+
+    def __len__(self): return len(next(iter(self.cols.values()))) if self.cols else 0
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in _scaled_dims: return self.cols[key]
+            _, i = _scaled_dims[key]
+            return self.cols[key] * self.scale[i] + self.offset[i]
+        return self.__class__({k:v[key] for k,v in self.cols.items()}, self.scale, self.offset)
+
+    def __getattr__(self, name):
+        if name != 'cols' and name in self.cols: return self[name]
+        raise AttributeError(name)
+
+    def to_df(self) -> pd.DataFrame:
+        "Return points as dataframe, with `x`, `y` and `z` scaled"
+        return pd.DataFrame({d: self[d] for d in self.dims})
+
+    def __repr__(self): return f'{self.__class__.__name__} n={len(self)} dims={self.dims}'
+
+def las_to_df(fn:str, dims:list=las_dims) -> pd.DataFrame:
+    """Open .las-file and return it as dataframe with columns `dims`, default
+    [x, y, z, num_returns, return_num, scan_angle_rank, intensity]. Only `dims` are read, in their native dtypes"""
+    return PointCloud.from_las(fn, dims).to_df()
+
+def mask_plot_from_lidar(lidar_df:(pd.DataFrame, PointCloud), plot_x:float=None, plot_y:float=None, radius:float=9,
+                         index:'PlotIndex'=None) -> (pd.DataFrame, PointCloud):
+    """Select only the circular field plot area as used lidar data, center point of plot is <plot_x, plot_y>.
+    If `index` built from `lidar_df` is given, only points in the grid cells overlapping the plot are checked"""
+    x, y = np.asarray(lidar_df.x), np.asarray(lidar_df.y)
+    if plot_x is None: plot_x = (x.max() - x.min()) / 2 + x.min()
+    if plot_y is None: plot_y = (y.max() - y.min()) / 2 + y.min()
+    if index is not None: return lidar_df[index.mask(plot_x, plot_y, radius)]
+    return lidar_df[circle_mask(x, y, plot_x, plot_y, radius)]
+
+class PlotIndex():
+    """Grid index over point cloud x-y -coordinates, for running several circular plot queries
+    (different centers or radii) against the same point cloud without rescanning all points"""
+    def __init__(self, x:np.ndarray, y:np.ndarray, cell_size:float=5.):
+        self.x, self.y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        self.cell_size = cell_size
+        self.xmin, self.ymin = self.x.min(), self.y.min()
+        self.ncols = int((self.x.max() - self.xmin) // cell_size) + 1
+        self.nrows = int((self.y.max() - self.ymin) // cell_size) + 1
+        cells = (((self.y - self.ymin) // cell_size).astype(np.int64) * self.ncols
+                 + ((self.x - self.xmin) // cell_size).astype(np.int64))
+        # Points sorted by cell, starts[c]:starts[c+1] are the positions of points in cell c
+        self.order = np.argsort(cells, kind='stable')
+        self.starts = np.searchsorted(cells[self.order], np.arange(self.ncols * self.nrows + 1))
 
-def mask_plot_from_lidar(lidar_df:pd.DataFrame, plot_x:float=None, plot_y:float=None, radius:float=9) -> pd.DataFrame:
-    "Select only the circular field plot area as used lidar data, center point of plot is <plot_x, plot_y>"
-    if plot_x is None: plot_x = (lidar_df.x.max() - lidar_df.x.min()) / 2 + lidar_df.x.min()
-    if plot_y is None: plot_y = (lidar_df.y.max() - lidar_df.y.min()) / 2 + lidar_df.y.min()
-    lidar_df = lidar_df[lidar_df.apply(lambda row:np.linalg.norm(np.array([row.x, row.y]).T - np.array([plot_x, plot_y]).T) <= radius, axis=1)]
-    return lidar_df
+    @classmethod
+    def from_df(cls, lidar_df:(pd.DataFrame, PointCloud), cell_size:float=5.):
+        "Build index from dataframe returned by `las_to_df` or from `PointCloud`"
+        return cls(np.asarray(lidar_df.x), np.asarray(lidar_df.y), cell_size=cell_size)
+
+    def query(self, plot_x:float, plot_y:float, radius:float) -> np.ndarray:
+        "Return indices of the points within `radius` from <plot_x, plot_y>, in original point order"
+        c0, c1 = [int(np.clip((v - self.xmin) // self.cell_size, 0, self.ncols-1)) for v in (plot_x-radius, plot_x+radius)]
+        r0, r1 = [int(np.clip((v - self.ymin) // self.cell_size, 0, self.nrows-1)) for v in (plot_y-radius, plot_y+radius)]
+        # Cells are ordered row by row, so each row of the bounding box is a contiguous slice
+        rows = np.arange(r0, r1+1) * self.ncols
+        cand = np.concatenate([self.order[self.starts[r+c0]:self.starts[r+c1+1]] for r in rows])
+        idx = cand[circle_mask(self.x[cand], self.y[cand], plot_x, plot_y, radius)]
+        return np.sort(idx)
+
+    def mask(self, plot_x:float, plot_y:float, radius:float) -> np.ndarray:
+        "Boolean mask of the points within `radius` from <plot_x, plot_y>"
+        mask = np.zeros(len(self.x), dtype=bool)
+        mask[self.query(plot_x, plot_y, radius)] = True
+        return mask
 
 # Cell
 
@@ -105,6 +184,113 @@ def normalized_shannon_entropy(z, binsize=1, zmax=None):
     S = -np.sum(p * np.log(p)) / -np.sum(pref*np.log(pref))
     return S
 
+# Cell
+
+def _hist_cdf(counts:np.ndarray, bin_size:float, t:np.ndarray, lo:float=None, hi:float=None,
+              right:bool=False) -> np.ndarray:
+    """Approximate number of values below `t` (at or below if `right`) from histogram `counts`, assuming values are
+    uniform within bins. The bins containing the known minimum `lo` and maximum `hi` are narrowed to start at `lo`
+    and end at `hi`, so values that all share the same height are counted exactly"""
+    nb = len(counts)
+    cum = np.concatenate(([0], np.cumsum(counts)))
+    t = np.asarray(t, dtype=np.float64)
+    k = np.clip(np.floor(t / bin_size), 0, nb - 1).astype(np.int64)
+    start, end = k * bin_size, (k + 1) * bin_size
+    _bin = lambda z: np.clip(int(np.floor(z / bin_size)), 0, nb - 1)
+    if lo is not None and np.isfinite(lo): start = np.where(k == _bin(lo), lo, start)
+    if hi is not None and np.isfinite(hi): end = np.where(k == _bin(hi), hi, end)
+    width = end - start
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(width > 0, np.clip((t - start) / width, 0, 1), (t > start) | (right & (t >= start)))
+    return cum[k] + (cum[k+1] - cum[k]) * frac
+
+def _hist_quantiles(counts:np.ndarray, bin_size:float, qs:np.ndarray, lo:float, hi:float) -> np.ndarray:
+    """Approximate quantiles `qs` of the values in histogram `counts`, clipped to the known range [`lo`, `hi`].
+    Order statistics are placed evenly within their bins and interpolated linearly like `pd.Series.quantile`"""
+    cum = np.cumsum(counts)
+    def _order_stat(r):
+        k = np.searchsorted(cum, r, side='right')
+        before = np.where(k > 0, cum[np.maximum(k-1, 0)], 0)
+        return (k + (r - before + .5) / counts[k]) * bin_size
+    pos = np.asarray(qs) * (cum[-1] - 1)
+    r0 = np.floor(pos)
+    v0, v1 = _order_stat(r0), _order_stat(np.minimum(r0 + 1, cum[-1] - 1))
+    return np.clip(v0 + (v1 - v0) * (pos - r0), lo, hi)
+
+class HeightSketch():
+    """Mergeable fixed-resolution histogram of point heights and intensities, for calculating height quantile
+    metrics approximately in constant memory. Can be passed to `z_quantiles`, `z_cumul` and `i_cumul_zq` in place
+    of the point dataframe. Sketches of different chunks or plots are combined with `merge` or `+`.
+
+    Heights are counted in `bin_size` meter bins from 0 to `max_h`, heights outside are put to the first or last bin.
+    Points are assumed to be evenly spread within each bin. For heights within [0, `max_h`] the difference to the
+    exact results is at most:
+      * `bin_size` for quantiles (`zqx` and the height quantiles used in `izqx`)
+      * the proportion of vegetation points in the bin containing the threshold for `zpcumx`
+      * the proportion of intensity in the bin containing each height quantile and its two neighbours for `izqx`
+    `min_h` should be a multiple of `bin_size` so that the vegetation points are selected exactly.
+    Points exactly at `min_h` are counted as vegetation points for all metrics."""
+    def __init__(self, bin_size:float=0.05, max_h:float=50.):
+        self.bin_size, self.max_h = bin_size, max_h
+        self.nbins = int(np.ceil(max_h / bin_size))
+        self.counts = np.zeros(self.nbins, dtype=np.int64)
+        self.isums = np.zeros(self.nbins)
+        self.zmin, self.zmax = np.inf, -np.inf
+
+    @classmethod
+    def from_points(cls, z:np.ndarray, intensity:np.ndarray=None, bin_size:float=0.05, max_h:float=50.):
+        "Create sketch from height and intensity arrays"
+        return cls(bin_size, max_h).update(z, intensity)
+
+    def _bins(self, z): return np.clip((np.asarray(z) / self.bin_size).astype(np.int64), 0, self.nbins-1)
+
+    def update(self, z:np.ndarray, intensity:np.ndarray=None):
+        "Add points to the sketch"
+        z = np.asarray(z, dtype=np.float64)
+        if len(z) == 0: return self
+        b = self._bins(z)
+        self.counts += np.bincount(b, minlength=self.nbins)
+        if intensity is not None:
+            self.isums += np.bincount(b, weights=np.asarray(intensity, dtype=np.float64), minlength=self.nbins)
+        self.zmin, self.zmax = min(self.zmin, z.min()), max(self.zmax, z.max())
+        return self
+
+    def merge(self, o:'HeightSketch'):
+        "Combine points of `o` to this sketch"
+        assert (self.bin_size, self.nbins) == (o.bin_size, o.nbins)
+        self.counts, self.isums = self.counts + o.counts, self.isums + o.isums
+        self.zmin, self.zmax = min(self.zmin, o.zmin), max(self.zmax, o.zmax)
+        return self
+
+    def __add__(self, o):
+        if isinstance(o, int) and o == 0: return self # so that `sum` works
+        return deepcopy(self).merge(o)
+    __radd__ = __add__
+
+    def __len__(self): return int(self.counts.sum())
+
+    def _vege(self, min_h:float) -> tuple:
+        "Return number of points and sum of intensities below the first vegetation bin, and the vegetation counts"
+        start = self._bins(min_h)
+        counts = self.counts.copy()
+        counts[:start] = 0
+        return self.counts[:start].sum(), self.isums[:start].sum(), counts
+
+    def quantiles(self, qs:np.ndarray, min_h:float=0.) -> np.ndarray:
+        "Approximate quantiles `qs` of the heights at or above `min_h`"
+        _, _, counts = self._vege(min_h)
+        return _hist_quantiles(counts, self.bin_size, qs, max(min_h, self.zmin), self.zmax)
+
+    def count_below(self, t:np.ndarray, right:bool=False) -> np.ndarray:
+        "Approximate number of points below heights `t`, or at or below them if `right`"
+        return _hist_cdf(self.counts, self.bin_size, t, self.zmin, self.zmax, right)
+
+    def intensity_below(self, t:np.ndarray, right:bool=False) -> np.ndarray:
+        "Approximate sum of intensities of the points below heights `t`, or at or below them if `right`"
+        return _hist_cdf(self.isums, self.bin_size, t, self.zmin, self.zmax, right)
+
+# Cell
+
 def height_metrics(lasfile:pd.DataFrame, min_h:float=1.5) -> list:
     return z_stats(lasfile, min_h) + z_percentages(lasfile, min_h) + z_quantiles(lasfile, min_h) + z_cumul(lasfile, min_h)
 
@@ -127,14 +313,20 @@ def z_percentages(lasfile:pd.DataFrame, min_h:float=1.5) -> list:
     pzabovex = [len(vege[vege.z > q]) / len(vege) for q in quantiles[1:-1]]
     return [pzabovemean] + pzabovex
 
-def z_quantiles(lasfile:pd.DataFrame, min_h:float=1.5) -> list:
-    "Calculate `zqx` for x in 1...9"
+def z_quantiles(lasfile:(pd.DataFrame, HeightSketch), min_h:float=1.5) -> list:
+    "Calculate `zqx` for x in 1...9. Approximate if `lasfile` is `HeightSketch`"
+    if isinstance(lasfile, HeightSketch): return list(lasfile.quantiles(np.linspace(.05,.95,19), min_h))
     vege = lasfile[lasfile.z >= min_h]
     quantiles = [vege.z.quantile(q) for q in np.linspace(.05,.95,19)]
     return quantiles
 
-def z_cumul(lasfile:pd.DataFrame, min_h:float=1.5) -> list:
-    "Calculate `zpcumx` for x in 1...9. lidR version excludes highest point from calculations"
+def z_cumul(lasfile:(pd.DataFrame, HeightSketch), min_h:float=1.5) -> list:
+    """Calculate `zpcumx` for x in 1...9. lidR version excludes highest point from calculations.
+    Approximate if `lasfile` is `HeightSketch`"""
+    if isinstance(lasfile, HeightSketch):
+        n_below, _, counts = lasfile._vege(min_h)
+        intervals = np.linspace(max(0, min_h), lasfile.zmax, 11)[1:10]
+        return list((lasfile.count_below(intervals) - n_below) / counts.sum())
     vege = lasfile[lasfile.z >= min_h]
     intervals = np.linspace(max(0, min_h), vege.z.max(), 11)
     cum_percentages = [len(vege.z[vege.z < interv])/len(vege) for interv in intervals]
@@ -163,8 +355,13 @@ def i_stats(lasfile:pd.DataFrame, min_h:float=1.5) -> list:
     ikurt = kurtosis(vege.intensity, fisher=False)
     return [itot, imax, imean, isd, iskew, ikurt]
 
-def i_cumul_zq(lasfile:pd.DataFrame, min_h:float=1.5) -> list:
-    "Calculate `ipcumzqx` for x in 1,3,5,7,9"
+def i_cumul_zq(lasfile:(pd.DataFrame, HeightSketch), min_h:float=1.5) -> list:
+    "Calculate `ipcumzqx` for x in 1,3,5,7,9. Approximate if `lasfile` is `HeightSketch`"
+    if isinstance(lasfile, HeightSketch):
+        _, i_below, _ = lasfile._vege(min_h)
+        itot = lasfile.isums.sum() - i_below
+        quantiles = lasfile.quantiles(np.linspace(.1,.9,5), min_h)
+        return list((lasfile.intensity_below(quantiles, right=True) - i_below) / itot)
     vege = lasfile[lasfile.z > min_h]
     itot = np.nansum(vege.intensity)
     quantiles = [vege.z.quantile(q) for q in np.linspace(.1,.9,5)]
@@ -207,6 +404,80 @@ density_cols = [f'D{int(q):02d}' for q in np.linspace(0,90,10)]
 
 # Cell
 
+def _sorted_quantiles(z_sorted:np.ndarray, qs:np.ndarray) -> np.ndarray:
+    "Linearly interpolated quantiles `qs` from already sorted `z_sorted`, same as `pd.Series.quantile`"
+    pos = qs * (len(z_sorted) - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, len(z_sorted) - 1)
+    return z_sorted[lo] + (z_sorted[hi] - z_sorted[lo]) * (pos - lo)
+
+def _moment_stats(v:np.ndarray) -> list:
+    "Return mean, standard deviation, skewness and kurtosis (not Fisher's) of `v` from one set of central moments"
+    mean = v.mean()
+    d = v - mean
+    d2 = d * d
+    m2, m3, m4 = d2.mean(), (d2 * d).mean(), (d2 * d2).mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return [mean, np.sqrt(m2), m3 / m2**1.5, m4 / m2**2]
+
+def stdmetrics(z:np.ndarray, intensity:np.ndarray, scan_angle_rank:np.ndarray, min_h:float=1.5) -> list:
+    """Calculate all `point_cloud_metric_cols` from point arrays in a single pass.
+    `z` is sorted once, and every metric is read from the sorted buffer with `np.searchsorted`
+    and cumulative sums, so the vegetation points are never filtered more than once.
+    Gives the same results as combining `height_metrics`, `intensity_metrics`, `class_metrics`
+    and `density_metrics`. Metrics that need vegetation points are `np.nan` if there are none."""
+    z = np.asarray(z, dtype=np.float64)
+    n = len(z)
+    angle = np.nanmean(np.abs(scan_angle_rank)) if n > 0 else np.nan
+    with profile_stage('sort_points', n): # shared by all metric families
+        order = np.argsort(z, kind='stable')
+        z_sorted = z[order]
+        i_sorted = np.asarray(intensity, dtype=np.float64)[order]
+
+    # `z_*` metrics use z >= min_h, the rest z > min_h
+    ge = np.searchsorted(z_sorted, min_h, side='left')
+    gt = np.searchsorted(z_sorted, min_h, side='right')
+    if gt == n: return [n, angle] + [np.nan] * (len(point_cloud_metric_cols) - 2)
+
+    # Height metrics
+    with profile_stage('z_stats', n - ge):
+        zv = z_sorted[ge:]
+        nv = len(zv)
+        zmax = zv[-1]
+        z_moments = _moment_stats(zv)
+        zmean = z_moments[0]
+        z_stat = [zmax] + z_moments + [normalized_shannon_entropy(zv)]
+        above = np.linspace(min_h, zmax, 11)[1:-1]
+        z_pct = [(nv - np.searchsorted(zv, zmean, side='right')) / nv]
+        z_pct += list((nv - np.searchsorted(zv, above, side='right')) / nv)
+        z_quant = list(_sorted_quantiles(zv, np.linspace(.05,.95,19)))
+        intervals = np.linspace(max(0, min_h), zmax, 11)[1:10]
+        z_cumul = list(np.searchsorted(zv, intervals, side='left') / nv)
+
+    # Intensity metrics
+    with profile_stage('i_stats', n - gt):
+        zi = z_sorted[gt:]
+        iv = i_sorted[gt:]
+        itot = np.nansum(iv)
+        i_stat = [itot, np.nanmax(iv)] + _moment_stats(iv)
+        icum = np.concatenate(([0.], np.nancumsum(iv)))
+        zq = _sorted_quantiles(zi, np.linspace(.1,.9,5))
+        i_cumul = list(icum[np.searchsorted(zi, zq, side='right')] / itot)
+
+    # Class metrics
+    with profile_stage('class_metrics', n):
+        n_ground = np.searchsorted(z_sorted, 0, side='right') - np.searchsorted(z_sorted, 0, side='left')
+        classes = [len(zi) / n, n_ground / n, n_ground / len(zi)]
+
+    # Density metrics, interval ends are inclusive like in `pd.Series.between`
+    with profile_stage('density_metrics', len(zi)):
+        levels = np.linspace(zi[0], zi[-1], 11)
+        dens = list((np.searchsorted(zi, levels[1:], side='right') - np.searchsorted(zi, levels[:-1], side='left')) / len(zi))
+
+    return [n, angle] + z_stat + z_pct + z_quant + z_cumul + i_stat + i_cumul + classes + dens
+
+# Cell
+
 def point_cloud_metrics(fn:str, plot_x:float=None, plot_y:float=None, mask_plot:bool=True, min_h:float=1.5,
                         radius=9):
     """
@@ -240,16 +511,18 @@ def point_cloud_metrics(fn:str, plot_x:float=None, plot_y:float=None, mask_plot:
       * `veg_ground_ratio`: proportion of vegetation points and ground points
       * `Dx`, where `Dx` is the proportion of points in the interval [level_x, level_(x+1)]
 
-    With `min_h=0` works almost identically to stdmetrics.
+    With `min_h=0` works almost identically to stdmetrics. `fn` is either a path or a `PointCloud` with
+    at least these dimensions, and `x` and `y` if `mask_plot`.
     """
-    lasfile = las_to_df(fn)
-    if mask_plot == True: lasfile = mask_plot_from_lidar(lasfile, radius=radius, plot_x=plot_x, plot_y=plot_y)
-    n = len(lasfile)
+    dims = ['z', 'intensity', 'scan_angle_rank']
+    if isinstance(fn, PointCloud): lasfile = fn
+    else: lasfile = PointCloud.from_las(fn, dims=['x', 'y'] + dims if mask_plot else dims)
+    if mask_plot == True:
+        with profile_stage('mask_plot', len(lasfile)):
+            lasfile = mask_plot_from_lidar(lasfile, radius=radius, plot_x=plot_x, plot_y=plot_y)
     # area is excluded because all of our plots have the same radius
     #area = (lasfile.x.max() - lasfile.x.min()) * (lasfile.y.max() - lasfile.y.min())
-    angle = np.nanmean(np.abs(lasfile.scan_angle_rank))
-    return ([n, angle] + height_metrics(lasfile, min_h) + intensity_metrics(lasfile, min_h)
-            + class_metrics(lasfile, min_h) + density_metrics(lasfile, min_h))
+    return stdmetrics(lasfile.z, lasfile.intensity, lasfile.scan_angle_rank, min_h=min_h)
 
 point_cloud_metric_cols = ['n', 'angle'] + z_cols + i_cols + class_cols + density_cols
 
@@ -260,6 +533,55 @@ from fastai.data.all import *
 from fastai.vision.all import *
 from fastai.vision.data import *
 
+# Cell
+def _bin_index(v, edges):
+    "Bin index of `v` in `edges` and mask of values inside them, same rules as `np.histogramdd`"
+    n = len(edges) - 1
+    idx = np.clip(((v - edges[0]) * (n / (edges[-1] - edges[0]))).astype(np.int64), 0, n-1)
+    # Correct off-by-one rounding of the arithmetic bin against the actual edges
+    idx -= (v < edges[idx]) & (idx > 0)
+    idx += (v >= edges[idx+1]) & (idx < n-1)
+    return idx, (v >= edges[0]) & (v <= edges[-1])
+
+def voxel_counts(coords, edges) -> np.ndarray:
+    "Point counts for each voxel defined by `edges`, equal to `np.histogramdd(coords, bins=edges)[0]`"
+    shape = tuple(len(e) - 1 for e in edges)
+    flat, valid = np.zeros(len(coords[0]), dtype=np.int64), np.ones(len(coords[0]), dtype=bool)
+    for v, e, n in zip(coords, edges, shape):
+        idx, ok = _bin_index(np.asarray(v), e)
+        flat = flat * n + idx
+        valid &= ok
+    return np.bincount(flat[valid], minlength=int(np.prod(shape))).reshape(shape).astype(np.float64)
+
+def fill_bottom_voxels(H:np.ndarray) -> np.ndarray:
+    """Set all voxels of each column to 1 from the bottom up to the topmost occurrence of the column maximum.
+    Empty columns get only their lowest voxel set."""
+    colmax = H.max(axis=2, keepdims=True)
+    top = H.shape[2] - 1 - np.argmax((H == colmax)[..., ::-1], axis=2)
+    top[colmax[..., 0] == 0] = 0
+    return np.where(np.arange(H.shape[2]) <= top[..., None], 1, H)
+
+class SparseVoxels():
+    """Coordinate list of the non-empty voxels of a grid with `shape`: flat `int32` indices `idx` and
+    `uint16` values `vals`. Values of `get_las_data` are point counts or ones, counts above 65535 are clipped"""
+    def __init__(self, idx:np.ndarray, vals:np.ndarray, shape:tuple): self.idx, self.vals, self.shape = idx, vals, tuple(shape)
+
+    @classmethod
+    def from_dense(cls, H:np.ndarray):
+        idx = np.flatnonzero(H)
+        return cls(idx.astype(np.int32), np.minimum(H.flat[idx], 65535).astype(np.uint16), H.shape)
+
+    def to_dense(self) -> np.ndarray:
+        H = np.zeros(int(np.prod(self.shape)), dtype=np.float32)
+        H[self.idx] = self.vals
+        return H.reshape(self.shape)
+
+    @property
+    def nbytes(self) -> int: return self.idx.nbytes + self.vals.nbytes
+
+    def __len__(self): return len(self.idx)
+    def __repr__(self): return f'{self.__class__.__name__} size={"x".join([str(d) for d in self.shape])} nnz={len(self)}'
+
 # Cell
 class VoxelImage(TensorImage):
     "Class for 3D Voxel image, todo add"
@@ -281,13 +603,15 @@ class VoxelImage(TensorImage):
         if isinstance(fn, ndarray):
             im = torch.from_numpy(fn)
             return cls(im)
+        if isinstance(fn, SparseVoxels): return fn
         if isinstance(fn, str) or isinstance(fn, Path):
-            return cls(get_las_data(fn, **kwargs))
+            o = get_las_data(fn, **kwargs)
+            return o if isinstance(o, SparseVoxels) else cls(o)
 
     def __repr__(self): return f'{self.__class__.__name__} size={"x".join([str(d) for d in self.shape])}'
 
 def get_las_data(fn, bin_voxels:bool=False, max_h:float=42., num_bins:int=40, num_vert_bins:int=105,
-                 plot_size:float=9., bottom_voxels:bool=False, mask_plot:bool=False) -> np.ndarray:
+                 plot_size:float=9., bottom_voxels:bool=False, mask_plot:bool=False, sparse:bool=False) -> np.ndarray:
     """
     Create voxel grid from lidar point cloud file. Plot center is calculated based on image data
     Other arguments:
@@ -298,50 +622,37 @@ def get_las_data(fn, bin_voxels:bool=False, max_h:float=42., num_bins:int=40, nu
         `plot_size`: radius for field plot, default 9 (m)
         `bottom_voxels`: whether to voxelize all locations below a voxel, default False
         `mask_plot`: whether to mask all areas outside the 9m radius, default False
+        `sparse`: whether to return `SparseVoxels` instead of a dense array, default False
     """
-    #fn = inps#[0]
-    #plot_x = inps[1]
-    #plot_y = inps[2]
-    lasfile = laspy.file.File(fn, mode='r')
+    lasfile = PointCloud.from_las(fn, dims=['x', 'y', 'z'])
     plot_x = (lasfile.x.max() - lasfile.x.min()) / 2 + lasfile.x.min()
     plot_y = (lasfile.y.max() - lasfile.y.min()) / 2 + lasfile.y.min()
-    coords = np.vstack((lasfile.x, lasfile.y, lasfile.z)).T
     min_vals = (plot_x-plot_size, plot_y-plot_size)
 
-    scales = lasfile.header.scale
-
-    num_bins = 40
-    num_vert_bins = 105
+    scales = lasfile.scale
 
     # Create bins and calculate histograms
-    H, edges = np.histogramdd(coords, bins=(np.linspace(min_vals[0]-scales[0], min_vals[0] + 2*plot_size, num_bins + 1),
-                                            np.linspace(min_vals[1]-scales[1], min_vals[1] + 2*plot_size, num_bins + 1),
-                                            np.linspace(0, max_h, num_vert_bins+1)))
+    edges = (np.linspace(min_vals[0]-scales[0], min_vals[0] + 2*plot_size, num_bins + 1),
+             np.linspace(min_vals[1]-scales[1], min_vals[1] + 2*plot_size, num_bins + 1),
+             np.linspace(0, max_h, num_vert_bins+1))
+    H = voxel_counts((lasfile.x, lasfile.y, lasfile.z), edges)
 
     if bin_voxels: H = np.where(H!=0,1,0)
 
-    if bottom_voxels:
-        for x, y in product(range(num_bins), range(num_bins)):
-            if np.max(H[x,y]) == 0: max_idx_of_voxel = 0
-            else:
-                max_idx_of_voxel = np.argwhere(H[x,y] == np.max(H[x,y])).max()
-            for z in range(max_idx_of_voxel+1):
-                H[x,y,z] = 1
+    if bottom_voxels: H = fill_bottom_voxels(H)
 
     if mask_plot:
         center = (int(H.shape[0]/2), int(H.shape[1]/2))
         X, Y = np.ogrid[:H.shape[0], :H.shape[1]]
-        dist_from_center = np.sqrt((X-center[0])**2 + (Y-center[1])**2)
-        mask = dist_from_center <= H.shape[0]/2
+        mask = circle_mask(X, Y, center[0], center[1], H.shape[0]/2)
         H[~mask,:] = 0
 
-    lasfile.close()
     H = np.moveaxis(H, 2, 0)
     H = H[None,...]
 
     H = H.astype(np.float32)
 
-    return H
+    return SparseVoxels.from_dense(H) if sparse else H
 
 #VoxelImage.create = Transform(VoxelImage.create)
 
@@ -372,6 +683,53 @@ def VoxelBlock(cls=VoxelImage, **kwargs):
 
 # Cell
 
+def _voxel_dihedral(x:Tensor, k:int) -> Tensor:
+    "Apply dihedral symmetry `k` (bit 0: flip x, bit 1: flip y, bit 2: transpose) to the last two dims of `x`"
+    if k & 4: x = x.transpose(-1, -2)
+    if k & 1: x = x.flip(-1)
+    if k & 2: x = x.flip(-2)
+    return x
+
+def _z_shift(x:Tensor, s:int) -> Tensor:
+    "Shift `x` by `s` voxels along the vertical axis, filling with zeros"
+    if s == 0: return x
+    out = torch.zeros_like(x)
+    if s > 0: out[:,:,s:] = x[:,:,:-s]
+    else:     out[:,:,:s] = x[:,:,-s:]
+    return out
+
+class VoxelDihedral(RandTransform):
+    """Apply a random x-y dihedral symmetry to each `VoxelImage` of a batch with probability `p`, and shift it
+    vertically by a random number of voxels in `[-max_z_shift, max_z_shift]`. Samples drawing the same
+    symmetry or shift are transformed together, so a batch takes at most 8 flips and `2*max_z_shift+1` shifts"""
+    split_idx, order = 0, 5
+    def __init__(self, p:float=1., max_z_shift:int=0, **kwargs):
+        super().__init__(**kwargs)
+        self.p_item, self.max_z_shift = p, max_z_shift
+
+    def before_call(self, b, split_idx):
+        self.do = True
+        x = b[0] if isinstance(b, tuple) else b
+        bs, square = x.shape[0], x.shape[-1] == x.shape[-2]
+        self.ks = torch.randint(0, 8 if square else 4, (bs,))
+        self.ks[torch.rand(bs) >= self.p_item] = 0
+        self.shifts = torch.randint(-self.max_z_shift, self.max_z_shift+1, (bs,))
+
+    def _apply(self, x:Tensor, choices:Tensor, f) -> Tensor:
+        if (choices == 0).all(): return x
+        out = x.clone()
+        for c in choices.unique().tolist():
+            if c == 0: continue
+            m = (choices == c).to(x.device)
+            out[m] = f(x[m], c)
+        return out
+
+    def encodes(self, x:VoxelImage):
+        x = self._apply(x, self.ks, _voxel_dihedral)
+        return self._apply(x, self.shifts, _z_shift)
+
+# Cell
+
 class LasColReader(DisplayedTransform):
     "Modify `ColReader` to return coordinates from dataframe"
     def __init__(self, cols, pref='', suff='.las'):
@@ -391,13 +749,156 @@ class LasColReader(DisplayedTransform):
 
 # Cell
 
+def densify_voxels(items) -> VoxelImage:
+    "Stack a list of `SparseVoxels` with the same shape into a dense `VoxelImage` batch in one scatter"
+    shape = items[0].shape
+    size = int(np.prod(shape))
+    idx = np.concatenate([o.idx.astype(np.int64) + i*size for i, o in enumerate(items)])
+    vals = np.concatenate([o.vals for o in items]).astype(np.float32)
+    out = torch.zeros(len(items)*size)
+    out[torch.from_numpy(idx)] = torch.from_numpy(vals)
+    return VoxelImage(out.view(len(items), *shape))
+
+def sparse_collate(b):
+    "`fa_collate` that densifies `SparseVoxels` only when the batch is created"
+    if isinstance(b[0], SparseVoxels): return densify_voxels(b)
+    if isinstance(b[0], tuple): return type(b[0])(sparse_collate(s) for s in zip(*b))
+    return fa_collate(b)
+
+# Cell
+
+class VoxelStore():
+    """Voxel grids of a set of plots created with `get_las_data`, in a single memory-mapped `.npy` file or,
+    when `sparse`, as the concatenated `SparseVoxels` of all plots with the offsets of each plot.
+    `meta.json` holds the voxelization parameters and the row of each plot, so that a store
+    built with different parameters is detected as stale and rebuilt"""
+    data_fname, meta_fname = 'voxels.npy', 'meta.json'
+    sparse_fnames = ('voxel_idx.npy', 'voxel_vals.npy', 'voxel_offsets.npy')
+
+    def __init__(self, path, voxel_kwargs:dict, keys:list):
+        self.path, self.voxel_kwargs = Path(path), voxel_kwargs
+        self.index = {k:i for i, k in enumerate(keys)}
+        self._data = None
+
+    @staticmethod
+    def voxel_kwargs(bin_voxels:bool=False, max_h:float=42., num_bins:int=40, num_vert_bins:int=105,
+                     plot_size:float=9., bottom_voxels:bool=False, mask_plot:bool=False, sparse:bool=False) -> dict:
+        "Full set of `get_las_data` parameters that define the contents of a store"
+        return {'bin_voxels':bin_voxels, 'max_h':max_h, 'num_bins':num_bins, 'num_vert_bins':num_vert_bins,
+                'plot_size':plot_size, 'bottom_voxels':bottom_voxels, 'mask_plot':mask_plot, 'sparse':sparse}
+
+    @property
+    def shape(self) -> tuple:
+        "Shape of a single voxel grid"
+        return (1, self.voxel_kwargs['num_vert_bins'], self.voxel_kwargs['num_bins'], self.voxel_kwargs['num_bins'])
+
+    @classmethod
+    def _fnames(cls, sparse:bool) -> tuple: return cls.sparse_fnames if sparse else (cls.data_fname,)
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        "Open the store in `path`. Returns `None` if it does not exist or was built with other parameters"
+        path, vkw = Path(path), cls.voxel_kwargs(**kwargs)
+        if not (path/cls.meta_fname).exists(): return None
+        if not all((path/f).exists() for f in cls._fnames(vkw['sparse'])): return None
+        meta = json.loads((path/cls.meta_fname).read_text())
+        if meta['voxel_kwargs'] != vkw: return None
+        return cls(path, meta['voxel_kwargs'], meta['keys'])
+
+    @staticmethod
+    def _voxelize(fns:list, vkw:dict, n_workers:int, chunk_size:int):
+        "Yield the offset and `get_las_data` grids of each chunk of `fns`"
+        for i in progress_bar(range(0, len(fns), chunk_size), leave=False):
+            yield i, parallel(partial(get_las_data, **vkw), fns[i:i+chunk_size], n_workers=n_workers, progress=False)
+
+    def _write_dense(self, old, fns, n_workers, chunk_size):
+        n_old = 0 if old is None else len(old)
+        tmp = self.path/f'{self.data_fname}.tmp'
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(n_old+len(fns), *self.shape))
+        for i in range(0, n_old, chunk_size): data[i:min(i+chunk_size, n_old)] = old.data[i:i+chunk_size]
+        for i, grids in self._voxelize(fns, self.voxel_kwargs, n_workers, chunk_size):
+            data[n_old+i:n_old+i+len(grids)] = np.stack(grids)
+        data.flush()
+        del data
+        if old is not None: old.close()
+        os.replace(tmp, self.path/self.data_fname)
+
+    def _write_sparse(self, old, fns, n_workers, chunk_size):
+        idx, vals, offsets = old.data if old is not None else (np.zeros(0, np.int32), np.zeros(0, np.uint16), np.zeros(1, np.int64))
+        grids = [o for _, gs in self._voxelize(fns, self.voxel_kwargs, n_workers, chunk_size) for o in gs]
+        arrs = (np.concatenate([idx] + [o.idx for o in grids]), np.concatenate([vals] + [o.vals for o in grids]),
+                np.concatenate([offsets, offsets[-1] + np.cumsum([len(o) for o in grids], dtype=np.int64)]))
+        if old is not None: old.close()
+        for fname, arr in zip(self.sparse_fnames, arrs):
+            np.save(self.path/f'{fname}.tmp.npy', arr)
+            os.replace(self.path/f'{fname}.tmp.npy', self.path/fname)
+
+    @classmethod
+    def build(cls, df:pd.DataFrame, path, store_path, fn_col=0, folder=None, suff:str='.las',
+              n_workers:int=defaults.cpus, chunk_size:int=256, rebuild:bool=False, **kwargs):
+        """Voxelize the plots of `df` into `store_path`. Files are read from `path/folder/{fn_col}{suff}`.
+        Plots already in an up-to-date store are not voxelized again, and a store built with
+        other voxel parameters is replaced"""
+        vkw = cls.voxel_kwargs(**kwargs)
+        old = None if rebuild else cls.open(store_path, **vkw)
+        old_keys = list(old.index) if old is not None else []
+        col = df[fn_col] if not isinstance(fn_col, int) else df.iloc[:,fn_col]
+        new_keys = [k for k in dict.fromkeys(str(o) for o in col) if old is None or k not in old.index]
+        if old is not None and not new_keys: return old
+        pref = Path(path) if folder is None else Path(path)/folder
+        fns = [pref/f'{k}{suff}' for k in new_keys]
+        store = cls(store_path, vkw, old_keys + new_keys)
+        store.path.mkdir(parents=True, exist_ok=True)
+        # A stale store is invalid from here on, even if writing fails
+        if old is None and (store.path/cls.meta_fname).exists(): (store.path/cls.meta_fname).unlink()
+        if vkw['sparse']: store._write_sparse(old, fns, n_workers, chunk_size)
+        else:             store._write_dense(old, fns, n_workers, chunk_size)
+        (store.path/cls.meta_fname).write_text(json.dumps({'voxel_kwargs':vkw, 'keys':old_keys + new_keys}))
+        return store
+
+    @property
+    def data(self):
+        """Memory-mapped array of all grids with shape `(n, 1, num_vert_bins, num_bins, num_bins)`,
+        or `(idx, vals, offsets)` arrays of a sparse store"""
+        # Copy-on-write so that the items are writable views that are never written back to disk
+        if self._data is None:
+            arrs = tuple(np.load(self.path/f, mmap_mode='c') for f in self._fnames(self.voxel_kwargs['sparse']))
+            self._data = arrs if self.voxel_kwargs['sparse'] else arrs[0]
+        return self._data
+
+    def close(self): self._data = None
+
+    def __len__(self): return len(self.index)
+    def __contains__(self, key): return str(key) in self.index
+
+    def __getitem__(self, key):
+        "Voxel grid or `SparseVoxels` of plot `key` as views to the memory-mapped files"
+        key = str(key)
+        if key not in self.index: raise KeyError(f'{key} is not in voxel store {self.path}, rebuild it with `VoxelStore.build`')
+        i = self.index[key]
+        if not self.voxel_kwargs['sparse']: return self.data[i]
+        idx, vals, offsets = self.data
+        return SparseVoxels(idx[offsets[i]:offsets[i+1]], vals[offsets[i]:offsets[i+1]], self.shape)
+
+    def __call__(self, key): return self[key]
+
+    def __getstate__(self): return {k:v for k, v in self.__dict__.items() if k != '_data'}
+    def __setstate__(self, state): self.__dict__.update(state); self._data = None
+
+    def __repr__(self): return f'{self.__class__.__name__} path={self.path} n={len(self)} {self.voxel_kwargs}'
+
+# Cell
+
 class VoxelDataLoaders(DataLoaders):
     @classmethod
     @delegates(DataLoaders.from_dblock)
     def from_df(cls, df, path='.', bin_voxels:bool=False, max_h:float=42., num_bins:int=40, num_vert_bins:int=105,
                 plot_size:float=9., bottom_voxels:bool=False, mask_plot:bool=False, valid_pct=0.2, seed=None, fn_col=0,
                 folder=None, suff='.las', label_col=1, label_delim=None, y_block=None, valid_col=None,
-                item_tfms=None, batch_tfms=None, **kwargs):
+                item_tfms=None, batch_tfms=None, voxel_store=None, sparse:bool=False, **kwargs):
+        """Create from `df`. If `voxel_store` is given, the grids are read from a `VoxelStore` instead of the las files.
+        A `VoxelStore` instance must have been built with the same voxel parameters, a path is built or updated.
+        With `sparse`, items are kept as `SparseVoxels` and densified when batches are collated"""
         pref = f'{Path(path) if folder is None else Path(path)/folder}{os.path.sep}'
         if y_block is None:
             is_multi = (is_listy(label_col) and (len_label_col) > 1) or label_delim is not None
@@ -405,7 +906,15 @@ class VoxelDataLoaders(DataLoaders):
         splitter = RandomSplitter(valid_pct, seed=seed) if valid_col is None else ColSplitter(valid_col)
         # Todo put block_kwargs to a single argument
         block_kwargs = {'bin_voxels':bin_voxels, 'max_h':max_h, 'num_bins':num_bins, 'num_vert_bins': num_vert_bins,
-                        'plot_size':plot_size, 'bottom_voxels':bottom_voxels, 'mask_plot':mask_plot}
+                        'plot_size':plot_size, 'bottom_voxels':bottom_voxels, 'mask_plot':mask_plot, 'sparse':sparse}
+        get_x = ColReader(fn_col, pref=pref, suff=suff)
+        if voxel_store is not None:
+            if not isinstance(voxel_store, VoxelStore):
+                voxel_store = VoxelStore.build(df, path, voxel_store, fn_col=fn_col, folder=folder, suff=suff,
+                                               **block_kwargs)
+            diff = {k:(v, block_kwargs[k]) for k, v in voxel_store.voxel_kwargs.items() if block_kwargs[k] != v}
+            if diff: raise ValueError(f'`voxel_store` was built with other voxel parameters, (stored, requested): {diff}')
+            get_x = Pipeline([ColReader(fn_col), voxel_store])
         dblock = DataBlock(blocks=(VoxelBlock(**block_kwargs), y_block),
                            #get_items=partial(get_files_from_df, extension='.las', df=df, fn_col=fn_col),
                            #get_x=partial(get_las_files_and_voxel_kwargs, df=df,
@@ -413,11 +922,12 @@ class VoxelDataLoaders(DataLoaders):
                            #get_y=partial(get_y_las, df=df, col=label_col),
                            #get_x=LasColReader(fn_col, pref=pref, suff='.las'),
                            #get_x= lambda x:([x[fn_col], [x['x'], x['y']]]),
-                           get_x=ColReader(fn_col, pref=pref, suff=suff),
+                           get_x=get_x,
                            get_y=ColReader(label_col, label_delim=label_delim),
                            splitter=splitter,
                            item_tfms=item_tfms,
                            batch_tfms=batch_tfms)
+        if sparse: kwargs['create_batch'] = sparse_collate
         return cls.from_dblock(dblock, df, path=path, **kwargs)
 
     @classmethod
@@ -429,21 +939,275 @@ VoxelDataLoaders.from_csv = delegates(to=VoxelDataLoaders.from_df)(VoxelDataLoad
 
 # Cell
 
-def lastile_to_df(fn, res:int=16) -> pd.DataFrame:
-    "Tile dataframe, to `res` times `res` cells and process as dataframe."
-    tile = laspy.file.File(fn, mode='r')
-    xmin = np.floor(tile.x.min())
-    xmax = np.ceil(tile.x.max())
-    ymin = np.floor(tile.y.min())
-    ymax = np.ceil(tile.y.max())
-    ncols = int(np.floor((xmax - xmin) / res))
-    nrows = int(np.floor((ymax - ymin) / res))
-    for col, row in product(range(0, ncols), range(0, nrows)):
-        cell_xmin = xmin + col*res
-        cell_xmax = cell_xmin + res
-        cell_ymin = ymin + row*res
-        cell_ymax = cell_ymin + row*res
-        celldata_x = np.logical_and((tile.x >= cell_xmin), (tile.x <= cell_xmax))
-        celldata_y = np.logical_and((tile.y >= cell_ymin), (tile.y <= cell_ymax))
-        cell = tile.points[np.where(np.logical_and(celldata_x, celldata_y))]
-        print(cell.x, col, row)
\ No newline at end of file
+def _grid_extent(xmin:float, ymin:float, xmax:float, ymax:float, res:float) -> tuple:
+    "Return `(xmin, ymax, nrows, ncols)` of a `res` grid snapped to full meters and covering the bounds"
+    xmin, ymax = np.floor(xmin), np.ceil(ymax)
+    ncols = max(1, int(np.ceil((np.ceil(xmax) - xmin) / res)))
+    nrows = max(1, int(np.ceil((ymax - np.floor(ymin)) / res)))
+    return xmin, ymax, nrows, ncols
+
+def _grid_cells(x:np.ndarray, y:np.ndarray, res:float, xmin:float, ymax:float, nrows:int, ncols:int) -> np.ndarray:
+    "Assign each point to a `res` times `res` cell, rows counted from the top. Returns `row * ncols + col`"
+    cols = np.clip(((x - xmin) // res).astype(np.int64), 0, ncols-1)
+    rows = np.clip(((ymax - y) // res).astype(np.int64), 0, nrows-1)
+    return rows * ncols + cols
+
+def _add_cell_coords(df:pd.DataFrame, cells:np.ndarray, res:float, xmin:float, ymax:float, ncols:int) -> pd.DataFrame:
+    "Insert `row`, `col` and cell center `x` and `y` as the first columns of `df`"
+    rows, cols = np.divmod(cells, ncols)
+    df.insert(0, 'y', ymax - (rows + .5) * res)
+    df.insert(0, 'x', xmin + (cols + .5) * res)
+    df.insert(0, 'col', cols)
+    df.insert(0, 'row', rows)
+    return df
+
+def grid_metrics(pc:PointCloud, res:float=16, min_h:float=1.5) -> tuple:
+    """Calculate `point_cloud_metric_cols` for each non-empty `res` times `res` cell of `pc`.
+    Points are assigned to cells in one pass and grouped with a single sort on (cell, z).
+    Returns `(df, transform, (nrows, ncols))`, where `df` has columns `row`, `col`, `x` and `y`
+    (cell center) followed by the metrics, and `transform` is the affine transform of the grid"""
+    x, y = pc.x, pc.y
+    xmin, ymax, nrows, ncols = _grid_extent(x.min(), y.min(), x.max(), y.max(), res)
+    cells = _grid_cells(x, y, res, xmin, ymax, nrows, ncols)
+    z, intensity, angle = pc.z, pc.intensity, pc.scan_angle_rank
+    order = np.lexsort((z, cells))
+    cells, z, intensity, angle = cells[order], z[order], intensity[order], angle[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    ends = np.r_[starts[1:], len(cells)]
+    metrics = [stdmetrics(z[s:e], intensity[s:e], angle[s:e], min_h=min_h) for s, e in zip(starts, ends)]
+    df = _add_cell_coords(pd.DataFrame(metrics, columns=point_cloud_metric_cols), cells[starts], res, xmin, ymax, ncols)
+    return df, rio.transform.from_origin(xmin, ymax, res, res), (nrows, ncols)
+
+def lastile_to_df(fn, res:int=16, min_h:float=1.5) -> pd.DataFrame:
+    "Tile .las-file to `res` times `res` cells and calculate `point_cloud_metric_cols` for each cell"
+    pc = PointCloud.from_las(fn, dims=['x', 'y', 'z', 'intensity', 'scan_angle_rank'])
+    return grid_metrics(pc, res=res, min_h=min_h)[0]
+
+def grid_to_raster(df:pd.DataFrame, outfile, transform, shape:tuple, cols:list=point_cloud_metric_cols, crs=None):
+    "Write `cols` of `df` from `grid_metrics` as bands of a float32 GeoTIFF, empty cells are NaN"
+    data = np.full((len(cols), *shape), np.nan, dtype=np.float32)
+    data[:, df.row.values, df.col.values] = df[cols].values.astype(np.float32).T
+    with rio.open(str(outfile), 'w', driver='GTiff', height=shape[0], width=shape[1], count=len(cols),
+                  dtype='float32', crs=crs, transform=transform, nodata=np.nan,
+                  tiled=True, compress='deflate') as dst:
+        dst.write(data)
+        for i, c in enumerate(cols): dst.set_band_description(i+1, c)
+
+def lastile_to_raster(fn, outfile, res:int=16, min_h:float=1.5, crs=None) -> pd.DataFrame:
+    "Calculate `point_cloud_metric_cols` for `res` times `res` cells of .las-file, write them to `outfile` and return them"
+    pc = PointCloud.from_las(fn, dims=['x', 'y', 'z', 'intensity', 'scan_angle_rank'])
+    df, transform, shape = grid_metrics(pc, res=res, min_h=min_h)
+    grid_to_raster(df, outfile, transform, shape, crs=crs)
+    return df
+
+# Cell
+
+def iter_las_chunks(fn, chunk_size:int=1_000_000, dims:list=las_dims):
+    """Yield `PointCloud`s of at most `chunk_size` consecutive points of .las-file. Only one chunk of
+    `dims` is copied out of the memory map at a time, so memory use is bounded by `chunk_size`"""
+    lasfile = laspy.file.File(str(fn), mode='r')
+    try:
+        views = {d: getattr(lasfile, _scaled_dims[d][0] if d in _scaled_dims else d) for d in dims}
+        for start in range(0, len(lasfile), chunk_size):
+            yield PointCloud({d: np.array(v[start:start+chunk_size]) for d, v in views.items()},
+                             lasfile.header.scale, lasfile.header.offset)
+    finally:
+        lasfile.close()
+
+class _Moments():
+    "Count, mean and central moment sums of values in groups, mergeable with the pairwise update formulas of Pébay"
+    def __init__(self, ngroups:int):
+        self.n = np.zeros(ngroups)
+        self.mean, self.m2, self.m3, self.m4 = [np.zeros(ngroups) for _ in range(4)]
+
+    @classmethod
+    def from_values(cls, groups:np.ndarray, values:np.ndarray, ngroups:int):
+        res = cls(ngroups)
+        res.n = np.bincount(groups, minlength=ngroups).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res.mean = np.nan_to_num(np.bincount(groups, weights=values, minlength=ngroups) / res.n)
+        d = values - res.mean[groups]
+        d2 = d * d
+        res.m2 = np.bincount(groups, weights=d2, minlength=ngroups)
+        res.m3 = np.bincount(groups, weights=d2*d, minlength=ngroups)
+        res.m4 = np.bincount(groups, weights=d2*d2, minlength=ngroups)
+        return res
+
+    def merge(self, o:'_Moments'):
+        na, nb = self.n, o.n
+        n = na + nb
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = o.mean - self.mean
+            dn = np.where(n > 0, delta / n, 0.)
+            m4 = (self.m4 + o.m4 + delta * dn**3 * na * nb * (na*na - na*nb + nb*nb)
+                  + 6 * dn**2 * (na*na*o.m2 + nb*nb*self.m2) + 4 * dn * (na*o.m3 - nb*self.m3))
+            m3 = self.m3 + o.m3 + delta * dn**2 * na * nb * (na - nb) + 3 * dn * (na*o.m2 - nb*self.m2)
+            m2 = self.m2 + o.m2 + delta * dn * na * nb
+            self.mean = self.mean + dn * nb
+        self.n, self.m2, self.m3, self.m4 = n, m2, m3, m4
+        return self
+
+    def stats(self) -> tuple:
+        "Return mean, standard deviation, skewness and kurtosis (not Fisher's) for each group"
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m2 = self.m2 / self.n
+            return self.mean, np.sqrt(m2), self.m3 / self.n / m2**1.5, self.m4 / self.n / m2**2
+
+def _sum_by_key(keys:np.ndarray, counts:np.ndarray, isums:np.ndarray) -> tuple:
+    "Sum `counts` and `isums` of equal `keys`, returning the sorted unique keys and the sums"
+    keys, inv = np.unique(keys, return_inverse=True)
+    return (keys, np.bincount(inv, weights=counts, minlength=len(keys)).astype(np.int64),
+            np.bincount(inv, weights=isums, minlength=len(keys)))
+
+class PointCloudStats():
+    """Mergeable partial statistics for calculating `point_cloud_metric_cols` for `ngroups` cells or plots
+    without keeping the points in memory. `update` adds a chunk of points, and partial results from different
+    chunks or processes are combined with `merge` (or `+`). `finalize` returns the metrics.
+
+    Counts, moments, minimums, maximums and intensity sums are exact. Heights above `min_h` are kept in
+    histograms with bins of `bin_size` meters up to `max_h` (higher points go to the last bin), so metrics
+    based on height quantiles or thresholds (`pzabovex`, `zqx`, `zpcumx`, `izqx`, `Dx`, `zentropy`)
+    are approximations with an error of at most one bin, see `HeightSketch` for the bounds. Cells whose
+    vegetation points all have the same height, such as single point cells, get the exact values.
+
+    The histograms are sparse: only the (group, bin) pairs that contain points are stored, so memory grows
+    with the number of points and not with `ngroups` times the number of bins."""
+    def __init__(self, ngroups:int, min_h:float=1.5, bin_size:float=0.05, max_h:float=50.):
+        self.ngroups, self.min_h, self.bin_size, self.max_h = ngroups, min_h, bin_size, max_h
+        self.nbins = int(np.ceil(max_h / bin_size))
+        self.n, self.n_ground, self.n_eq, self.n_gt = [np.zeros(ngroups, dtype=np.int64) for _ in range(4)]
+        self.angle_sum, self.itot = np.zeros(ngroups), np.zeros(ngroups)
+        self.zmax, self.imax = np.full(ngroups, -np.inf), np.full(ngroups, -np.inf)
+        self.zmin = np.full(ngroups, np.inf)
+        self.z_moments, self.i_moments = _Moments(ngroups), _Moments(ngroups)
+        # Sparse histograms as parts of (group * nbins + bin, counts, intensity sums), see `_add_hist`
+        self.hist = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))]
+
+    def _add_hist(self, parts:list):
+        """Add sparse histogram parts. They are summed into the first part when they get larger than it,
+        so each (group, bin) pair is re-summed only a logarithmic number of times"""
+        self.hist = self.hist + list(parts)
+        if sum(len(keys) for keys, _, _ in self.hist[1:]) >= len(self.hist[0][0]):
+            self.hist = [_sum_by_key(*[np.concatenate(a) for a in zip(*self.hist)])]
+
+    def _bins(self, z): return np.clip((z / self.bin_size).astype(np.int64), 0, self.nbins-1)
+
+    def update(self, groups:np.ndarray, z:np.ndarray, intensity:np.ndarray, scan_angle_rank:np.ndarray):
+        "Add points, `groups` is the cell or plot index of each point"
+        C = self.ngroups
+        groups = np.asarray(groups, dtype=np.int64)
+        z, intensity = np.asarray(z, dtype=np.float64), np.asarray(intensity, dtype=np.float64)
+        self.n += np.bincount(groups, minlength=C)
+        self.angle_sum += np.bincount(groups, weights=np.abs(np.asarray(scan_angle_rank, dtype=np.float64)), minlength=C)
+        self.n_ground += np.bincount(groups[z == 0], minlength=C)
+        # Height metrics use points z >= min_h, others z > min_h
+        ge, gt = z >= self.min_h, z > self.min_h
+        self.n_eq += np.bincount(groups[ge & ~gt], minlength=C)
+        g, zg = groups[ge], z[ge]
+        self.z_moments.merge(_Moments.from_values(g, zg, C))
+        np.maximum.at(self.zmax, g, zg)
+        g, zg, ig = groups[gt], z[gt], intensity[gt]
+        self.i_moments.merge(_Moments.from_values(g, ig, C))
+        np.minimum.at(self.zmin, g, zg)
+        np.maximum.at(self.imax, g, ig)
+        self.itot += np.bincount(g, weights=ig, minlength=C)
+        self.n_gt += np.bincount(g, minlength=C)
+        self._add_hist([_sum_by_key(g * self.nbins + self._bins(zg), np.ones(len(g)), ig)])
+        return self
+
+    def merge(self, o:'PointCloudStats'):
+        "Combine partial statistics of `o` to these"
+        assert (self.ngroups, self.min_h, self.bin_size, self.nbins) == (o.ngroups, o.min_h, o.bin_size, o.nbins)
+        for a in ['n', 'n_ground', 'n_eq', 'n_gt', 'angle_sum', 'itot']:
+            setattr(self, a, getattr(self, a) + getattr(o, a))
+        self._add_hist(o.hist)
+        self.zmax, self.imax = np.maximum(self.zmax, o.zmax), np.maximum(self.imax, o.imax)
+        self.zmin = np.minimum(self.zmin, o.zmin)
+        self.z_moments.merge(o.z_moments)
+        self.i_moments.merge(o.i_moments)
+        return self
+
+    def __add__(self, o):
+        if isinstance(o, int) and o == 0: return self # so that `sum` works
+        return deepcopy(self).merge(o)
+    __radd__ = __add__
+
+    def _finalize_one(self, g:int, hist_gt:np.ndarray, ihist:np.ndarray, z_stats:list, i_stats:list) -> list:
+        n, n_gt, n_eq = self.n[g], self.n_gt[g], self.n_eq[g]
+        angle = self.angle_sum[g] / n if n > 0 else np.nan
+        if n_gt == 0: return [n, angle] + [np.nan] * (len(point_cloud_metric_cols) - 2)
+        bs, min_h, zmax, zmin = self.bin_size, self.min_h, self.zmax[g], self.zmin[g]
+        hist_ge = hist_gt.copy()
+        hist_ge[self._bins(np.array([min_h]))[0]] += n_eq
+        n_ge = n_gt + n_eq
+        def _cdf_gt(t, right=False): return _hist_cdf(hist_gt, bs, t, zmin, zmax, right)
+
+        zmean = z_stats[0][g]
+        centers = (np.arange(self.nbins) + .5) * bs
+        if zmax < 2: zentropy = None
+        else:
+            nb = int(np.ceil(zmax))
+            h = np.bincount(np.minimum(centers, nb - 1).astype(np.int64), weights=hist_ge, minlength=nb)[:nb] / n_ge
+            p = h[h > 0]
+            zentropy = -np.sum(p * np.log(p)) / np.log(len(h))
+        z_stat = [zmax] + [s[g] for s in z_stats] + [zentropy]
+        above = np.linspace(min_h, zmax, 11)[1:-1]
+        # Points exactly at `min_h` are not in `hist_gt`, and are all below the thresholds
+        z_pct = list(1 - (_cdf_gt(np.r_[zmean, above], right=True) + n_eq) / n_ge)
+        sketch = HeightSketch(bs, self.max_h)
+        sketch.counts, sketch.isums, sketch.zmax = hist_ge, ihist, zmax
+        sketch.zmin = min_h if n_eq > 0 else zmin
+        z_quant, z_cum = z_quantiles(sketch, min_h), z_cumul(sketch, min_h)
+
+        i_stat = [self.itot[g], self.imax[g]] + [s[g] for s in i_stats]
+        i_cum = i_cumul_zq(sketch, min_h)
+
+        classes = [n_gt / n, self.n_ground[g] / n, self.n_ground[g] / n_gt]
+        levels = np.linspace(zmin, zmax, 11)
+        dens = list((_cdf_gt(levels[1:], right=True) - _cdf_gt(levels[:-1])) / n_gt)
+        return [n, angle] + z_stat + z_pct + z_quant + z_cum + i_stat + i_cum + classes + dens
+
+    def finalize(self) -> pd.DataFrame:
+        "Return `point_cloud_metric_cols` for each group as a dataframe"
+        z_stats, i_stats = self.z_moments.stats(), self.i_moments.stats()
+        self.hist = [_sum_by_key(*[np.concatenate(a) for a in zip(*self.hist)])]
+        keys, counts, isums = self.hist[0]
+        bounds = np.searchsorted(keys, np.arange(self.ngroups + 1) * self.nbins)
+        rows = []
+        for g in range(self.ngroups):
+            # Dense histograms only for one group at a time
+            s, e = bounds[g], bounds[g+1]
+            hist, ihist = np.zeros(self.nbins, dtype=np.int64), np.zeros(self.nbins)
+            hist[keys[s:e] - g * self.nbins], ihist[keys[s:e] - g * self.nbins] = counts[s:e], isums[s:e]
+            rows.append(self._finalize_one(g, hist, ihist, z_stats, i_stats))
+        return pd.DataFrame(rows, columns=point_cloud_metric_cols)
+
+def stream_grid_metrics(fn, res:float=16, min_h:float=1.5, chunk_size:int=1_000_000, bin_size:float=0.05,
+                        max_h:float=50.) -> tuple:
+    """Out-of-core version of `grid_metrics` for .las-files larger than memory. Reads `chunk_size` points at a time
+    and accumulates them to `PointCloudStats`, see it for the approximations. Grid extent is taken from the header.
+    Returns `(df, transform, (nrows, ncols))` like `grid_metrics`"""
+    lasfile = laspy.file.File(str(fn), mode='r')
+    (xmin, ymin, _), (xmax, ymax, _) = lasfile.header.min, lasfile.header.max
+    lasfile.close()
+    xmin, ymax, nrows, ncols = _grid_extent(xmin, ymin, xmax, ymax, res)
+    stats = PointCloudStats(nrows * ncols, min_h=min_h, bin_size=bin_size, max_h=max_h)
+    for pc in iter_las_chunks(fn, chunk_size, dims=['x', 'y', 'z', 'intensity', 'scan_angle_rank']):
+        stats.update(_grid_cells(pc.x, pc.y, res, xmin, ymax, nrows, ncols), pc.z, pc.intensity, pc.scan_angle_rank)
+    df = stats.finalize()
+    cells = np.flatnonzero(stats.n > 0)
+    df = _add_cell_coords(df.iloc[cells].reset_index(drop=True), cells, res, xmin, ymax, ncols)
+    return df, rio.transform.from_origin(xmin, ymax, res, res), (nrows, ncols)
+
+def stream_plot_metrics(fn, plots:pd.DataFrame, radius:float=9, min_h:float=1.5, chunk_size:int=1_000_000,
+                        bin_size:float=0.05, max_h:float=50., x_col:str='x', y_col:str='y') -> pd.DataFrame:
+    """Out-of-core `point_cloud_metrics` for all circular plots of `plots` located within a large .las-file.
+    Returns a dataframe with the metrics for each row of `plots`, see `PointCloudStats` for the approximations"""
+    stats = PointCloudStats(len(plots), min_h=min_h, bin_size=bin_size, max_h=max_h)
+    for pc in iter_las_chunks(fn, chunk_size, dims=['x', 'y', 'z', 'intensity', 'scan_angle_rank']):
+        index = PlotIndex(pc.x, pc.y, cell_size=2*radius)
+        idxs = [index.query(px, py, radius) for px, py in zip(plots[x_col], plots[y_col])]
+        groups = np.repeat(np.arange(len(plots)), [len(i) for i in idxs])
+        idx = np.concatenate(idxs)
+        stats.update(groups, pc.z[idx], pc.intensity[idx], pc.scan_angle_rank[idx])
+    return stats.finalize().set_index(plots.index)
\ No newline at end of file
@@ -1,16 +1,161 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_model.ensemble.ipynb (unless otherwise specified).
 
-__all__ = ['Ensemble', 'load_ensemble']
+__all__ = ['StackedTabularModel', 'StackedLoss', 'Ensemble', 'load_ensemble']
 
 # Cell
 from fastai.basics import *
 from fastai.tabular.all import *
 
 # Cell
+class _StackedLinear(Module):
+    "`nn.Linear` layers of the same shape applied to inputs (batch, n, features), one for each of the n members"
+    def __init__(self, mods):
+        self.weight = nn.Parameter(torch.stack([m.weight.detach() for m in mods]))
+        self.bias = None if mods[0].bias is None else nn.Parameter(torch.stack([m.bias.detach() for m in mods]))
+
+    def forward(self, x):
+        x = torch.einsum('bni,noi->bno', x, self.weight)
+        return x if self.bias is None else x + self.bias
+
+    def unstack(self, mods):
+        for i, m in enumerate(mods):
+            m.weight.data.copy_(self.weight.data[i])
+            if self.bias is not None: m.bias.data.copy_(self.bias.data[i])
+
+class _StackedBatchNorm(nn.BatchNorm1d):
+    """`nn.BatchNorm1d` layers applied to inputs (batch, n, features), one for each of the n members.
+    Normalizing the n*features columns at once is the same as normalizing each member separately"""
+    def __init__(self, mods):
+        m = mods[0]
+        super().__init__(len(mods) * m.num_features, eps=m.eps, momentum=m.momentum, affine=m.affine,
+                         track_running_stats=m.track_running_stats)
+        with torch.no_grad():
+            for k in ['weight', 'bias', 'running_mean', 'running_var']:
+                if getattr(self, k) is not None: getattr(self, k).copy_(torch.cat([getattr(o, k) for o in mods]))
+            if self.track_running_stats: self.num_batches_tracked.copy_(m.num_batches_tracked)
+
+    def forward(self, x): return super().forward(x.reshape(x.shape[0], -1)).view(x.shape)
+
+    def unstack(self, mods):
+        for k in ['weight', 'bias', 'running_mean', 'running_var']:
+            if getattr(self, k) is None: continue
+            for m, v in zip(mods, getattr(self, k).data.chunk(len(mods))): getattr(m, k).data.copy_(v)
+        if self.track_running_stats:
+            for m in mods: m.num_batches_tracked.copy_(self.num_batches_tracked)
+
+class _StackedEmbedding(Module):
+    "`nn.Embedding` layers of the same shape, returning (batch, n, features) for the n members"
+    def __init__(self, mods): self.weight = nn.Parameter(torch.stack([m.weight.detach() for m in mods]))
+    def forward(self, x): return self.weight[:, x].transpose(0, 1)
+    def unstack(self, mods):
+        for i, m in enumerate(mods): m.weight.data.copy_(self.weight.data[i])
+
+def _stack_module(mods):
+    "Stack the layers `mods` of the members, layers without parameters are shared"
+    m = mods[0]
+    if isinstance(m, nn.Linear): return _StackedLinear(mods)
+    if isinstance(m, nn.BatchNorm1d): return _StackedBatchNorm(mods)
+    if isinstance(m, nn.Embedding): return _StackedEmbedding(mods)
+    if isinstance(m, (nn.Sequential, nn.ModuleList)):
+        stacked = [_stack_module([o[i] for o in mods]) for i in range(len(m))]
+        return nn.Sequential(*stacked) if isinstance(m, nn.Sequential) else nn.ModuleList(stacked)
+    assert len(list(m.parameters())) == 0, f'Cannot stack {type(m).__name__}'
+    return deepcopy(m)
+
+def _unstack_module(stacked, mods):
+    "Copy the weights of `stacked` back to the layers `mods` of the members"
+    if hasattr(stacked, 'unstack'): stacked.unstack(mods)
+    elif isinstance(stacked, (nn.Sequential, nn.ModuleList)):
+        for i, o in enumerate(stacked): _unstack_module(o, [m[i] for m in mods])
+
+class StackedTabularModel(Module):
+    """The `TabularModel`s of `models`, which have the same architecture, fused into one module with stacked
+    weights, so that all members are trained and evaluated in one pass. Returns predictions (batch, n_models, out)"""
+    def __init__(self, models):
+        m = models[0]
+        assert all(isinstance(o, TabularModel) for o in models), 'Only `TabularModel`s can be stacked'
+        self.n_models, self.n_emb, self.n_cont = len(models), m.n_emb, m.n_cont
+        self.embeds = _stack_module([o.embeds for o in models])
+        self.emb_drop = deepcopy(m.emb_drop)
+        self.bn_cont = None if m.bn_cont is None else _stack_module([o.bn_cont for o in models])
+        self.layers = _stack_module([o.layers for o in models])
+
+    def forward(self, x_cat, x_cont=None):
+        if self.n_emb != 0:
+            x = torch.cat([e(x_cat[:,i]) for i,e in enumerate(self.embeds)], -1)
+            x = self.emb_drop(x)
+        if self.n_cont != 0:
+            x_cont = x_cont[:,None].expand(-1, self.n_models, -1)
+            if self.bn_cont is not None: x_cont = self.bn_cont(x_cont)
+            x = torch.cat([x, x_cont], -1) if self.n_emb != 0 else x_cont
+        return self.layers(x)
+
+    def unstack(self, models):
+        "Copy the weights of each member back to `models`"
+        for k in ['embeds', 'bn_cont', 'layers']:
+            if getattr(self, k) is not None: _unstack_module(getattr(self, k), [getattr(o, k) for o in models])
+
+class StackedLoss():
+    "Sum of `loss_func` of each member of predictions (batch, n_models, ...), so that every member gets its own gradient"
+    def __init__(self, loss_func): self.loss_func = loss_func
+    def __call__(self, pred, targ): return sum(self.loss_func(pred[:,i], targ) for i in range(pred.shape[1]))
+    def activation(self, x): return getattr(self.loss_func, 'activation', noop)(x)
+
+class _MemberPred(GetAttr):
+    "`learn` with the predictions of only member `i` of a stacked model"
+    _default = 'learn'
+    def __init__(self, learn, i): self.learn, self.pred = learn, learn.pred[:,i]
+
+class _MemberMetric(Metric):
+    "`metric` of member `i` of the predictions (batch, n_models, ...) of a stacked model"
+    def __init__(self, metric, i): self.metric, self.i = deepcopy(mk_metric(metric)), i
+    def reset(self): self.metric.reset()
+    def accumulate(self, learn): self.metric.accumulate(_MemberPred(learn, self.i))
+    @property
+    def value(self): return self.metric.value
+    @property
+    def name(self): return f'{self.metric.name}_{self.i}'
+
+def _stacked_learner(learners, cbs=None) -> Learner:
+    """A `Learner` training the models of `learners` together as a `StackedTabularModel`.
+    The metrics of `learners` are recorded for each member, in member order"""
+    l = learners[0]
+    metrics = [_MemberMetric(m, i) for i in range(len(learners)) for m in l.metrics]
+    return Learner(l.dls, StackedTabularModel([m.model for m in learners]), loss_func=StackedLoss(l.loss_func),
+                   opt_func=l.opt_func, lr=l.lr, splitter=l.splitter, cbs=cbs, metrics=metrics, path=l.path,
+                   model_dir=l.model_dir, wd=l.wd, wd_bn_bias=l.wd_bn_bias, train_bn=l.train_bn, moms=l.moms)
+
+# Cell
+_recorder_attrs = ['lrs', 'iters', 'losses', 'values', 'metric_names']
+
+def _unstack_recorder(learn:Learner, learners):
+    """Copy the records of stacked `learn` to the recorders of `learners`, with the losses divided by the number
+    of members, as `StackedLoss` sums them, and only the metrics of each member"""
+    rec, n, n_met = learn.recorder, len(learners), len(learners[0].metrics)
+    n_loss = len(rec.values[0]) - n * n_met if rec.values else 0
+    names = rec.metric_names[:1+n_loss] + learners[0].metrics.attrgot('name') + rec.metric_names[1+n_loss+n*n_met:]
+    for i, l in enumerate(learners):
+        mets = slice(n_loss + i*n_met, n_loss + (i+1)*n_met)
+        l.recorder.lrs, l.recorder.iters = list(rec.lrs), list(rec.iters)
+        l.recorder.losses = [o / n for o in rec.losses]
+        l.recorder.values = [[o / n for o in v[:n_loss]] + list(v[mets]) for v in rec.values]
+        l.recorder.metric_names = names
+
+def _fit_member(item, n_epoch, lr_max, n_threads:int, **kwargs):
+    "Fit one `(learner, seed)` -item in a worker process, and return its weights and recorded values"
+    learn, seed = item
+    torch.set_num_threads(n_threads)
+    set_seed(seed)
+    with learn.no_bar(), learn.no_logging(): learn.fit_one_cycle(n_epoch, lr_max=lr_max, **kwargs)
+    state = {k: v.cpu() for k, v in learn.model.state_dict().items()}
+    return state, {k: getattr(learn.recorder, k) for k in _recorder_attrs}
+
 class Ensemble():
     def __init__(self, dls, n_models:int=10, learn_func=Learner, cv:bool=False, path=None,
-                 ens_dir='ensemble', **learner_kwargs):
+                 ens_dir='ensemble', stacked:bool=False, **learner_kwargs):
         """Create an ensemble of `Learner`s. learner_func defines what kind of learner is used.
+        With `stacked`, the models must be `TabularModel`s, and they are trained and validated together as one
+        `StackedTabularModel` in `stacked_learner`
         """
         self.path = Path(path) if path is not None else getattr(dls, 'path', Path('.'))
         self.ens_dir = ens_dir
@@ -24,18 +169,45 @@ class Ensemble():
                 self.models.append(learn_func(dls=fold_dls, path=path, model_dir=ens_dir, **learner_kwargs))
             else:
                 self.models.append(learn_func(dls=self.dls, path=path, model_dir=ens_dir, **learner_kwargs))
+        self.stacked_learner = _stacked_learner(self.models, cbs=learner_kwargs.get('cbs')) if stacked else None
 
-    def fit_one_cycle(self, n_iterations, lr_max, **kwargs):
-        "Fit the models with fit_one_cycle"
-        for m in self.models:
-            with m.no_logging(): m.fit_one_cycle(n_iterations, lr_max=lr_max, **kwargs)
+    def fit_one_cycle(self, n_iterations, lr_max, n_workers:int=0, n_threads:int=None, seed:int=None,
+                      method:str=None, **kwargs):
+        """Fit the models with fit_one_cycle. With `n_workers > 0` the models are trained concurrently in worker
+        processes, each limited to `n_threads` torch threads (by default the cpus split evenly between the workers)
+        and seeded with `seed + i` (random if `seed` is None). The fitted weights and recorders are copied back.
+        A stacked ensemble fits all models at once, and copies the weights and recorders back to `models`"""
+        stacked = getattr(self, 'stacked_learner', None)
+        if stacked is not None:
+            if seed is not None: set_seed(seed)
+            with stacked.no_logging(): stacked.fit_one_cycle(n_iterations, lr_max=lr_max, **kwargs)
+            stacked.model.unstack([m.model for m in self.models])
+            _unstack_recorder(stacked, self.models)
+            return
+        if n_workers == 0:
+            for i, m in enumerate(self.models):
+                if seed is not None: set_seed(seed + i)
+                with m.no_logging(): m.fit_one_cycle(n_iterations, lr_max=lr_max, **kwargs)
+            return
+        if n_threads is None: n_threads = max(1, defaults.cpus // n_workers)
+        if seed is None: seed = random.randint(0, 2**31 - self.n_models)
+        res = parallel(partial(_fit_member, n_epoch=n_iterations, lr_max=lr_max, n_threads=n_threads, **kwargs),
+                       [(m, seed + i) for i, m in enumerate(self.models)], n_workers=n_workers, method=method)
+        for m, (state, rec) in zip(self.models, res):
+            m.model.load_state_dict(state)
+            for k, v in rec.items(): setattr(m.recorder, k, v)
 
 
     def validate(self, dl=None) -> pd.DataFrame:
         "Validate all models individually and as an ensemble TODO fix to work with multitarget"
         if dl is None: dl=self.dls[1]
-        model_results = torch.cat([m.get_preds(reorder=False, dl=dl)[0][:,:,None] for m in self.models], dim=-1)
-        targs = self.models[0].get_preds(reorder=False, dl=dl)[1]
+        stacked = getattr(self, 'stacked_learner', None)
+        if stacked is not None:
+            model_results, targs = stacked.get_preds(reorder=False, dl=dl)
+            model_results = model_results.transpose(1, 2)
+        else:
+            model_results = torch.cat([m.get_preds(reorder=False, dl=dl)[0][:,:,None] for m in self.models], dim=-1)
+            targs = self.models[0].get_preds(reorder=False, dl=dl)[1]
         ensemble_results = model_results.sum(axis=-1) / len(self.models)
         res_ls = []
         for c in range(dl.c):
@@ -92,8 +264,8 @@ def export(self:Ensemble, folder='ensemble', pickle_protocol=2):
     and each model in `model_i.pkl`"""
     old_dls = self.dls
     self.dls = self.dls.new_empty()
-    old_models = self.models
-    self.models = []
+    old_models, old_stacked = self.models, getattr(self, 'stacked_learner', None)
+    self.models, self.stacked_learner = [], None
     if not os.path.exists(self.path/folder): os.makedirs(self.path/folder)
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
@@ -101,7 +273,7 @@ def export(self:Ensemble, folder='ensemble', pickle_protocol=2):
     for i, m in enumerate(old_models):
         m.export(fname=self.path/folder/f'model_{i}.pkl', pickle_protocol=pickle_protocol)
     self.dls = old_dls
-    self.models = old_models
+    self.models, self.stacked_learner = old_models, old_stacked
 
 # Cell
 def load_ensemble(folder, cpu=True):
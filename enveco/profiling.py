@@ -0,0 +1,109 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/08_profiling.ipynb (unless otherwise specified).
+
+__all__ = ['StageProfiler', 'profile_stage', 'profile_plot']
+
+# Cell
+import threading
+import json, time, tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+
+# Cell
+
+_profiler = None
+_reset_peak = getattr(tracemalloc, 'reset_peak', lambda: None)
+
+class _Stage():
+    "A running stage, `n` is the number of points or pixels it processed"
+    __slots__ = ('n',)
+    def __init__(self, n:int=None): self.n = n
+
+class StageProfiler():
+    """Opt-in recorder of the preprocessing stages marked with `profile_stage`, such as reading files, masking plots
+    and each metric family. Use as `with StageProfiler() as prof:`. Each record holds the plot set with `profile_plot`,
+    the stage, its wall time in seconds, number of points or pixels and, if `memory`, its peak memory in bytes
+    from `tracemalloc`. Memory is traced for the whole process, so it is exact only with one thread."""
+    columns = ['plot', 'stage', 'seconds', 'n', 'peak_mem']
+
+    def __init__(self, memory:bool=True):
+        self.memory, self.records, self._local = memory, [], threading.local()
+
+    def __enter__(self):
+        global _profiler
+        self._prev, _profiler = _profiler, self
+        self._tracing = self.memory and not tracemalloc.is_tracing()
+        if self._tracing: tracemalloc.start()
+        return self
+
+    def __exit__(self, *args):
+        global _profiler
+        _profiler = self._prev
+        if self._tracing: tracemalloc.stop()
+
+    @contextmanager
+    def plot(self, plot_id):
+        "Attribute the stages run by this thread in the enclosed code to `plot_id`"
+        prev, self._local.plot = getattr(self._local, 'plot', None), plot_id
+        try: yield
+        finally: self._local.plot = prev
+
+    @contextmanager
+    def stage(self, name:str, n:int=None):
+        "Record the enclosed code as stage `name`"
+        stack = self._local.__dict__.setdefault('stack', [])
+        mem = self.memory and tracemalloc.is_tracing()
+        cur, peak = tracemalloc.get_traced_memory() if mem else (0, 0)
+        if stack: stack[-1][1] = max(stack[-1][1], peak) # keep the peak of the enclosing stage before resetting
+        _reset_peak()
+        frame, st = [cur, cur], _Stage(n)
+        stack.append(frame)
+        start = time.perf_counter()
+        try: yield st
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            if mem: frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+            if stack: stack[-1][1] = max(stack[-1][1], frame[1])
+            _reset_peak()
+            self.records.append({'plot': getattr(self._local, 'plot', None), 'stage': name, 'seconds': seconds,
+                                 'n': st.n, 'peak_mem': frame[1] - frame[0] if mem else None})
+
+    def update(self, records:list):
+        "Add `records` of another profiler, such as one run in a worker process"
+        self.records.extend(records)
+        return self
+
+    def to_df(self) -> pd.DataFrame: return pd.DataFrame(self.records, columns=self.columns)
+
+    def summary(self) -> pd.DataFrame:
+        "Totals of the run for each stage: count, total, mean and max seconds, points or pixels and max peak memory"
+        return self.to_df().groupby('stage', sort=False).agg(
+            count=('seconds', 'size'), seconds=('seconds', 'sum'), mean_seconds=('seconds', 'mean'),
+            max_seconds=('seconds', 'max'), n=('n', 'sum'), max_n=('n', 'max'), peak_mem=('peak_mem', 'max'))
+
+    def per_plot(self) -> pd.DataFrame:
+        "Seconds spent in each stage (columns) for each plot (rows), slowest plots first"
+        df = self.to_df().pivot_table(index='plot', columns='stage', values='seconds', aggfunc='sum')
+        total = df['total'] if 'total' in df else df.sum(axis=1)
+        return df.loc[total.sort_values(ascending=False).index]
+
+    def export(self, fn):
+        "Write the summary of the run and all records to json file `fn`"
+        report = {'run': self.summary().reset_index().to_dict('records'), 'records': self.records}
+        Path(fn).write_text(json.dumps(report, default=lambda o: o.item() if hasattr(o, 'item') else str(o)))
+
+@contextmanager
+def profile_stage(name:str, n:int=None):
+    """Record the enclosed code as stage `name` of the active `StageProfiler`, if there is one.
+    The number of points or pixels is `n`, or set it with `.n` on the yielded stage"""
+    if _profiler is None: yield _Stage(n)
+    else:
+        with _profiler.stage(name, n) as st: yield st
+
+@contextmanager
+def profile_plot(plot_id):
+    "Attribute the stages in the enclosed code to `plot_id` in the active `StageProfiler`, if there is one"
+    if _profiler is None: yield
+    else:
+        with _profiler.plot(plot_id): yield
\ No newline at end of file
@@ -1,6 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_tabular.preprocessing.ipynb (unless otherwise specified).
 
-__all__ = ['EnvecoPreprocessor', 'process_one']
+__all__ = ['FeatureCache', 'IOStats', 'batch_features', 'batch_point_cloud_metrics', 'batch_image_features',
+           'FeatureStore', 'update_feature_table', 'EnvecoPreprocessor', 'process_one']
 
 # Cell
 from fastai.tabular.all import *
@@ -8,18 +9,346 @@ from fastai.data.all import *
 from fastai.vision.data import get_grid
 from ..data.las import *
 from ..data.image import *
+from ..profiling import *
 import matplotlib.patches as mpl_patches
 from typing import Tuple
 from fastai.metrics import *
 
 # Cell
 
-from tqdm import tqdm
-tqdm.pandas()
+import hashlib, inspect, json, shutil, time
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+def _file_hash(fn, block_size:int=2**20) -> str:
+    "sha1 of the contents of `fn`"
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for b in iter(lambda: f.read(block_size), b''): h.update(b)
+    return h.hexdigest()
+
+def _fingerprint(fn, hash_content:bool=False) -> str:
+    "Identifier of the contents of `fn`, from its path, size and modification time or a hash of its contents"
+    if hash_content: return _file_hash(fn)
+    st = os.stat(fn)
+    return f'{os.path.abspath(fn)}|{st.st_size}|{st.st_mtime_ns}'
+
+class FeatureCache():
+    """Persistent on-disk cache for per-plot features, such as the results of `point_cloud_metrics` and
+    `process_image_features`. Entries are keyed by the source file, the feature function and all its arguments,
+    defaults included. The source file is identified by its path, size and modification time, or by a hash of
+    its contents if `hash_content`. Least recently used entries are removed when the cache grows over `max_size`
+    bytes. With `verify` every hit is checked against a hash of the current file contents, and with `rebuild`
+    existing entries are ignored and overwritten."""
+    def __init__(self, path, max_size:int=2**30, hash_content:bool=False, verify:bool=False, rebuild:bool=False):
+        self.path, self.max_size = Path(path), max_size
+        self.hash_content, self.verify, self.rebuild = hash_content, verify, rebuild
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def fingerprint(self, fn) -> str:
+        "Identifier of the contents of `fn`"
+        return _fingerprint(fn, self.hash_content)
+
+    def key(self, func, fn, *args, **kwargs) -> str:
+        "Cache key for `func(fn, *args, **kwargs)`"
+        params = inspect.signature(func).bind(fn, *args, **kwargs)
+        params.apply_defaults()
+        params = {k:v for k, v in list(params.arguments.items())[1:]}
+        desc = [self.fingerprint(fn), f'{func.__module__}.{func.__qualname__}', sorted(params.items())]
+        return hashlib.sha1(repr(desc).encode()).hexdigest()
+
+    def _fn(self, key:str) -> Path: return self.path/key[:2]/f'{key}.pkl'
+
+    def get(self, key:str, fn=None):
+        "Return cached value for `key`, or None if it is missing, stale or `rebuild` is set"
+        cache_fn = self._fn(key)
+        if self.rebuild or not cache_fn.exists(): return None
+        try:
+            with open(cache_fn, 'rb') as f: entry = pickle.load(f)
+        except Exception: return None
+        if self.verify and fn is not None and entry['content_hash'] != _file_hash(fn): return None
+        os.utime(cache_fn) # mark as recently used
+        return entry['value']
+
+    def put(self, key:str, value, fn=None):
+        "Store `value` for `key`. The file is written to a temporary name first, so concurrent writers are safe"
+        cache_fn = self._fn(key)
+        cache_fn.parent.mkdir(exist_ok=True)
+        entry = {'value': value, 'content_hash': _file_hash(fn) if self.verify and fn is not None else None}
+        tmp = cache_fn.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f: pickle.dump(entry, f)
+        os.replace(tmp, cache_fn)
+
+    def size(self) -> int:
+        "Total size of the cache entries in bytes"
+        return sum(f.stat().st_size for f in self.path.glob('*/*.pkl'))
+
+    def evict(self):
+        "Remove least recently used entries until the cache is at most `max_size` bytes"
+        entries = sorted(((f.stat().st_mtime, f.stat().st_size, f) for f in self.path.glob('*/*.pkl')))
+        total = sum(e[1] for e in entries)
+        for _, size, f in entries:
+            if total <= self.max_size: break
+            f.unlink()
+            total -= size
+
+    def clear(self):
+        "Remove all entries"
+        for f in self.path.glob('*/*.pkl'): f.unlink()
+
+# Cell
+
+def _safe_features(item, func):
+    "Run `func` for one `(id, fn, *args)` -item and return `(result, error)` instead of raising"
+    _, fn, *args = item
+    try: return func(fn, *args), None
+    except Exception as e: return None, f'{type(e).__name__}: {e}'
+
+def _cache_lookup(cache:FeatureCache, func, item, **kwargs) -> tuple:
+    """`(key, value)` of one `(id, fn, *args)` -item in `cache`. A file that can't be fingerprinted is a miss
+    with key None, so that it fails in `_safe_features` and is reported with the other errors"""
+    try:
+        key = cache.key(func, item[1], *item[2:], **kwargs)
+        return key, cache.get(key, item[1])
+    except OSError: return None, None
+
+class IOStats():
+    "Seconds spent reading files, waiting for the reads and computing features in `batch_features` with `prefetch`"
+    def __init__(self, read:float=0., io_wait:float=0., compute:float=0., n:int=0):
+        self.read, self.io_wait, self.compute, self.n = read, io_wait, compute, n
+
+    def update(self, o:'IOStats'):
+        "Add the times and counts of `o`"
+        self.read, self.io_wait, self.compute, self.n = (self.read+o.read, self.io_wait+o.io_wait,
+                                                         self.compute+o.compute, self.n+o.n)
+        return self
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__} n={self.n} read={self.read:.2f}s io_wait={self.io_wait:.2f}s '
+                f'compute={self.compute:.2f}s')
+
+def _profiled_features(item, func, memory:bool=True) -> Tuple[tuple, list]:
+    "`_safe_features` for `item` with a `StageProfiler`, returns the result and the profiler records"
+    with StageProfiler(memory) as prof, profile_plot(item[0]), profile_stage('total'):
+        res = _safe_features(item, func)
+    return res, prof.records
+
+def _timed_read(item, read):
+    "`(data, error, seconds)` of `read` for the path of `item`"
+    start = time.perf_counter()
+    try:
+        with profile_plot(item[0]): return read(item[1]), None, time.perf_counter() - start
+    except Exception as e: return None, f'{type(e).__name__}: {e}', time.perf_counter() - start
+
+def _prefetched_features(items, func, read, prefetch:int=2, n_readers:int=2, profile:bool=False,
+                         memory:bool=True) -> Tuple[list, IOStats, list]:
+    """`_safe_features` for `items`, passing `func` the data from `read(path)` instead of the path. While one item
+    is computed, the next `prefetch` items are read in `n_readers` threads, so at most `prefetch+1` are in memory.
+    Returns the results, `IOStats` and the records of a `StageProfiler` if `profile`"""
+    res, stats = [], IOStats(n=len(items))
+    with ExitStack() as ctx:
+        prof = ctx.enter_context(StageProfiler(memory)) if profile else None
+        ex = ctx.enter_context(ThreadPoolExecutor(n_readers))
+        futs = deque(ex.submit(_timed_read, i, read) for i in items[:prefetch])
+        for j, item in enumerate(items):
+            start = time.perf_counter()
+            data, error, seconds = futs.popleft().result()
+            stats.io_wait += time.perf_counter() - start
+            stats.read += seconds
+            if j + prefetch < len(items): futs.append(ex.submit(_timed_read, items[j+prefetch], read))
+            start = time.perf_counter()
+            with profile_plot(item[0]), profile_stage('total'):
+                res.append((None, error) if error is not None else _safe_features((item[0], data, *item[2:]), func))
+            stats.compute += time.perf_counter() - start
+    return res, stats, [] if prof is None else prof.records
+
+def batch_features(df:pd.DataFrame, func, cols:list=None, id_col:str='sampleplotid', path_col:str='path',
+                   arg_cols:list=None, n_workers:int=defaults.cpus, chunksize:int=None, progress:bool=True,
+                   cache:FeatureCache=None, read=None, prefetch:int=0, n_readers:int=2, io_stats:IOStats=None,
+                   profiler:StageProfiler=None, **kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Run `func(path, *arg_cols, **kwargs)` for each unique `id_col` of `df` in a process pool.
+    Returns `(features, errors)`, where `features` has one row for each unique `id_col` in the order they first
+    appear in `df`, and `errors` lists the plots that raised an exception. Failed plots have NaN features.
+    If `func` returns lists, `cols` are used as column names. If `cache` is given, only the plots without
+    cached results are processed. With `read` and `prefetch > 0`, each worker runs `func(read(path), ...)` on
+    chunks of `chunksize` plots, reading the next `prefetch` files in `n_readers` threads during compute,
+    and the time spent is added to `io_stats`. With `profiler`, the stages of each processed plot, see
+    `profile_stage`, are recorded in the worker processes and added to `profiler`."""
+    uniq = df.drop_duplicates(id_col)
+    items = list(zip(uniq[id_col], uniq[path_col], *[uniq[c] for c in L(arg_cols)]))
+    res = [None] * len(items)
+    if cache is not None:
+        keys = [None] * len(items)
+        for j, i in enumerate(items):
+            keys[j], val = _cache_lookup(cache, func, i, **kwargs)
+            if val is not None: res[j] = (val, None)
+    todo = [j for j, r in enumerate(res) if r is None]
+    if chunksize is None: chunksize = max(1, len(todo) // (4 * max(n_workers, 1)))
+    if len(todo) > 0:
+        if read is not None and prefetch > 0:
+            chunks = [[items[j] for j in todo[k:k+chunksize]] for k in range(0, len(todo), chunksize)]
+            computed = parallel(partial(_prefetched_features, func=partial(func, **kwargs), read=read,
+                                        prefetch=prefetch, n_readers=n_readers, profile=profiler is not None,
+                                        memory=getattr(profiler, 'memory', False)), chunks,
+                                n_workers=n_workers, progress=progress)
+            for _, st, records in computed:
+                if io_stats is not None: io_stats.update(st)
+                if profiler is not None: profiler.update(records)
+            computed = [r for rs, _, _ in computed for r in rs]
+        elif profiler is not None:
+            computed = parallel(partial(_profiled_features, func=partial(func, **kwargs), memory=profiler.memory),
+                                [items[j] for j in todo], n_workers=n_workers, chunksize=chunksize, progress=progress)
+            for _, records in computed: profiler.update(records)
+            computed = [r for r, _ in computed]
+        else:
+            computed = parallel(partial(_safe_features, func=partial(func, **kwargs)), [items[j] for j in todo],
+                                n_workers=n_workers, chunksize=chunksize, progress=progress)
+        for j, r in zip(todo, computed):
+            res[j] = r
+            if cache is not None and r[1] is None and keys[j] is not None: cache.put(keys[j], r[0], items[j][1])
+        if cache is not None: cache.evict()
+    feats = pd.DataFrame([{} if r is None else dict(zip(cols, r)) if cols is not None else r for r, _ in res],
+                         columns=cols)
+    feats.insert(0, id_col, uniq[id_col].values)
+    errors = pd.DataFrame([(i[0], i[1], e) for i, (_, e) in zip(items, res) if e is not None],
+                          columns=[id_col, path_col, 'error'])
+    return feats, errors
+
+_read_las = partial(PointCloud.from_las, dims=['x', 'y', 'z', 'intensity', 'scan_angle_rank'])
+
+def batch_point_cloud_metrics(df:pd.DataFrame, id_col:str='sampleplotid', path_col:str='path',
+                              coord_cols:list=['x', 'y'], n_workers:int=defaults.cpus, chunksize:int=None,
+                              progress:bool=True, cache:FeatureCache=None, prefetch:int=0,
+                              io_stats:IOStats=None, profiler:StageProfiler=None, **kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Run `point_cloud_metrics` for all plots in `df` in parallel. `kwargs` are passed to `point_cloud_metrics`.
+    With `prefetch`, the point clouds are read ahead with `PointCloud.from_las`, see `batch_features`"""
+    return batch_features(df, point_cloud_metrics, cols=point_cloud_metric_cols, id_col=id_col, path_col=path_col,
+                          arg_cols=coord_cols, n_workers=n_workers, chunksize=chunksize, progress=progress,
+                          cache=cache, read=_read_las, prefetch=prefetch, io_stats=io_stats, profiler=profiler,
+                          **kwargs)
+
+def batch_image_features(df:pd.DataFrame, id_col:str='sampleplotid', path_col:str='path',
+                         n_workers:int=defaults.cpus, chunksize:int=None, progress:bool=True,
+                         cache:FeatureCache=None, prefetch:int=0, io_stats:IOStats=None,
+                         profiler:StageProfiler=None, **kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Run `process_image_features` for all plots in `df` in parallel. `kwargs` are passed to `process_image_features`.
+    With `prefetch`, the images are read ahead with `open_geotiff`, see `batch_features`"""
+    return batch_features(df, process_image_features, id_col=id_col, path_col=path_col, n_workers=n_workers,
+                          chunksize=chunksize, progress=progress, cache=cache, read=open_geotiff,
+                          prefetch=prefetch, io_stats=io_stats, profiler=profiler, **kwargs)
+
+def _warn_errors(errors:pd.DataFrame):
+    if len(errors) > 0: warnings.warn(f'Feature extraction failed for {len(errors)} plots:\n{errors.to_string(index=False)}')
+
+# Cell
+
+class FeatureStore():
+    """Columnar on-disk store of feature tables. Each table is a directory with one `.npy` file per column and
+    `schema.json`, which lists the columns, their dtypes and which of them are features. Features are stored as
+    float32, and `load` reads only the requested columns."""
+    schema_fname = 'schema.json'
+
+    def __init__(self, path): self.path = Path(path)
+
+    def __contains__(self, name:str) -> bool: return (self.path/name/self.schema_fname).exists()
+
+    def schema(self, name:str) -> dict:
+        "Schema of table `name`"
+        return json.loads((self.path/name/self.schema_fname).read_text())
+
+    def features(self, name:str) -> list:
+        "Feature columns of table `name`"
+        return self.schema(name)['features']
+
+    def save(self, name:str, df:pd.DataFrame, feature_cols:list):
+        "Save `df` as table `name`, replacing any existing table. `feature_cols` are stored as float32"
+        tmp = self.path/f'{name}.{os.getpid()}.tmp'
+        if tmp.exists(): shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        feature_cols = list(feature_cols)
+        cols = {}
+        for i, c in enumerate(df.columns):
+            arr = df[c].to_numpy(dtype=np.float32) if c in feature_cols else df[c].to_numpy()
+            if arr.dtype == object: arr = np.array(df[c].astype(str).tolist(), dtype=str)
+            np.save(tmp/f'c{i}.npy', arr, allow_pickle=False)
+            cols[c] = {'file': f'c{i}.npy', 'dtype': str(arr.dtype)}
+        (tmp/self.schema_fname).write_text(json.dumps({'columns': cols, 'features': feature_cols}))
+        if (self.path/name).exists(): shutil.rmtree(self.path/name)
+        os.replace(tmp, self.path/name)
+
+    def load(self, name:str, cols:list=None) -> pd.DataFrame:
+        "Load columns `cols` of table `name`, all columns by default"
+        schema = self.schema(name)['columns']
+        cols = list(schema) if cols is None else list(dict.fromkeys(cols))
+        return pd.DataFrame({c: np.load(self.path/name/schema[c]['file'], allow_pickle=False) for c in cols})
+
+# Cell
+
+def _params_hash(func, **kwargs) -> str:
+    "Short identifier of `func` and its keyword arguments, defaults included"
+    params = inspect.signature(func).bind_partial(**kwargs)
+    params.apply_defaults()
+    desc = [f'{func.__module__}.{func.__qualname__}', sorted(params.arguments.items())]
+    return hashlib.sha1(repr(desc).encode()).hexdigest()[:10]
+
+def _source_key(fn, args:list, hash_content:bool=False) -> str:
+    "Identifier of the source file and `arg_cols` values of one plot, None if the file can't be fingerprinted"
+    try: return repr([_fingerprint(fn, hash_content), *args])
+    except OSError: return None
+
+def update_feature_table(store:FeatureStore, name:str, df:pd.DataFrame, func, cols:list=None,
+                         id_col:str='sampleplotid', path_col:str='path', arg_cols:list=None,
+                         hash_content:bool=False, n_workers:int=defaults.cpus, progress:bool=True,
+                         cache:FeatureCache=None, read=None, prefetch:int=0, io_stats:IOStats=None,
+                         profiler:StageProfiler=None, **kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Incremental `batch_features`: keep the per-plot features of `func` in table `{name}_{h}` of `store`, where `h`
+    identifies `func` and `kwargs`. Only the plots of `df` that are missing from the table, whose source file
+    (see `FeatureCache.fingerprint`) or `arg_cols` changed, or that failed before, are processed and written to
+    the table. Returns `(features, errors)` for the unique `id_col` of `df`, in the order they first appear.
+    `read`, `prefetch`, `io_stats` and `profiler` are passed to `batch_features`."""
+    name = f'{name}_{_params_hash(func, **kwargs)}'
+    uniq = df.drop_duplicates(id_col)
+    keys = [_source_key(fn, args, hash_content) for fn, *args in zip(uniq[path_col], *[uniq[c] for c in L(arg_cols)])]
+    table = store.load(name) if name in store else None
+    stored = {} if table is None else dict(zip(table[id_col], table['source_key']))
+    # Plots whose file can't be read are always processed, so that they are reported and their old rows replaced
+    todo = np.array([k is None or stored.get(i) != k for i, k in zip(uniq[id_col], keys)], dtype=bool)
+    errors = pd.DataFrame(columns=[id_col, path_col, 'error'])
+    if todo.any():
+        feats, errors = batch_features(uniq[todo], func, cols=cols, id_col=id_col, path_col=path_col,
+                                       arg_cols=arg_cols, n_workers=n_workers, progress=progress, cache=cache,
+                                       read=read, prefetch=prefetch, io_stats=io_stats, profiler=profiler,
+                                       **kwargs)
+        failed = set(errors[id_col])
+        feats.insert(1, 'source_key', ['' if i in failed or k is None else k for i, k in
+                                       zip(feats[id_col], np.array(keys, dtype=object)[todo])])
+        if table is not None: table = pd.concat((table[~table[id_col].isin(feats[id_col])], feats), ignore_index=True)
+        else: table = feats
+        store.save(name, table, [c for c in table.columns if c not in (id_col, 'source_key')])
+    feats = uniq[[id_col]].merge(table.drop(columns='source_key'), on=id_col, how='left')
+    return feats.astype({c: np.float32 for c in feats.columns if c != id_col}), errors
+
+# Cell
+
+def _target_view(base:TabularPandas, target_col, log_y:bool=False) -> TabularPandas:
+    "`TabularPandas` for `target_col` sharing the processed columns and procs of `base`"
+    df = base.items.copy(deep=False)
+    if log_y: df[target_col] = np.log1p(df[target_col])
+    to = TabularPandas(df, cont_names=base.cont_names, y_names=target_col, inplace=True, reduce_memory=False)
+    to.split, to.procs = base.split, Pipeline(L(base.procs.fs) + L(to.procs.fs))
+    return to
 
 class EnvecoPreprocessor():
-    "Needs a bit refactoring"
-    def __init__(self, train_path, valid_path, test_path, **kwargs):
+    """Needs a bit refactoring. If `cache_dir` is given, extracted features are cached there with `FeatureCache`.
+    Features are computed or loaded once per feature space, and `view` gives `TabularPandas` for each target.
+    With `prefetch`, the next files are read during feature extraction, and the times are added to `io_stats`.
+    With `profile`, the stages of feature extraction are recorded in `profiler`, a `StageProfiler`"""
+    def __init__(self, train_path, valid_path, test_path, cache_dir=None, cache_size:int=2**30, prefetch:int=0,
+                 profile:bool=False, **kwargs):
+        self.cache = FeatureCache(cache_dir, max_size=cache_size) if cache_dir is not None else None
+        self.prefetch, self.io_stats = prefetch, IOStats()
+        self.profiler = StageProfiler() if profile else None
         self.train_df = pd.read_csv(train_path)
         self.train_df = self.train_df.rename(columns = lambda x: re.sub('[\.]+', '_', x))
         self.valid_df = pd.read_csv(valid_path)
@@ -29,196 +358,146 @@ class EnvecoPreprocessor():
         self.train_df['is_valid'] = 0
         self.valid_df['is_valid'] = 1
         self.train_val_df = pd.concat((self.train_df, self.valid_df))
+        self.tables, self.sources, self._bases = {}, {}, {}
+
+    def _features(self, source:str, path, n_workers:int, store:FeatureStore=None, **kwargs) -> pd.DataFrame:
+        """Features of `source` ('las' or 'image') for each unique `sampleplotid`, reading `{path}/{sampleplotid}.las`
+        or `.tif`. With `store`, only new or changed plots are processed, see `update_feature_table`"""
+        df = pd.concat((self.train_val_df, self.test_df))
+        df = df.assign(path=[f'{path}/{s}.{"las" if source == "las" else "tif"}' for s in df.sampleplotid])
+        io = dict(cache=self.cache, prefetch=self.prefetch, io_stats=self.io_stats, profiler=self.profiler)
+        if store is not None:
+            func, cols, arg_cols, read = ((point_cloud_metrics, point_cloud_metric_cols, ['x', 'y'], _read_las)
+                                          if source == 'las' else (process_image_features, None, None, open_geotiff))
+            feats, errors = update_feature_table(store, f'{source}_features', df, func, cols=cols, arg_cols=arg_cols,
+                                                 n_workers=n_workers, read=read, **io, **kwargs)
+        elif source == 'las': feats, errors = batch_point_cloud_metrics(df, n_workers=n_workers, **io, **kwargs)
+        else: feats, errors = batch_image_features(df, n_workers=n_workers, **io, **kwargs)
+        _warn_errors(errors)
+        return feats
+
+    def _merge(self, *feats) -> Tuple[pd.DataFrame, pd.DataFrame, list]:
+        "Join the features in `feats` to (train_val, test) -tables and return them with the feature columns"
+        trainval, test = self.train_val_df, self.test_df
+        for f in feats:
+            trainval = trainval.merge(f, on='sampleplotid', how='left')
+            test = test.merge(f, on='sampleplotid', how='left')
+        return trainval, test, [c for f in feats for c in f.columns if c != 'sampleplotid']
+
+    def _store(self, save_path, incremental:bool) -> FeatureStore:
+        if not incremental: return None
+        assert save_path is not None, '`save_path` is needed for incremental preprocessing'
+        return FeatureStore(save_path)
+
+    def _save(self, save_path, prefix:str, trainval, test, feature_cols):
+        "Save preprocessed tables as `{prefix}_trainval` and `{prefix}_test` to a `FeatureStore` in `save_path`"
+        store = FeatureStore(save_path)
+        store.save(f'{prefix}_trainval', trainval, feature_cols)
+        store.save(f'{prefix}_test', test, feature_cols)
+
+    def _load(self, path, prefix:str, target_col):
+        "Load the features, `target_col` and split of previously preprocessed tables, unless already loaded from `path`"
+        if self.sources.get(prefix) == str(path): return
+        store = FeatureStore(path)
+        if f'{prefix}_trainval' in store:
+            feature_cols = store.features(f'{prefix}_trainval')
+            trainval = store.load(f'{prefix}_trainval', feature_cols + L(target_col) + ['is_valid'])
+            test = store.load(f'{prefix}_test', feature_cols + L(target_col))
+        else: # Data preprocessed before `FeatureStore` was used
+            trainval = pd.read_csv(f'{path}/{prefix}_trainval.csv')
+            test = pd.read_csv(f'{path}/{prefix}_test.csv')
+            with open(f'{path}/{prefix}_features.txt', 'r') as f:
+                feature_cols = [c.rstrip() for c in f.readlines()]
+        self._set_tables(prefix, trainval, test, feature_cols, source=path)
+
+    def _set_tables(self, space:str, trainval, test, feature_cols, source=None):
+        "Keep the target independent (train_val, test) tables of feature space `space`, read from `source`"
+        self.tables[space] = (trainval, test, list(feature_cols))
+        self.sources[space] = None if source is None else str(source)
+        self._bases = {k:v for k,v in self._bases.items() if k[0] != space}
+
+    def _add_targets(self, space:str, target_col):
+        "Load the columns of `target_col` missing from the tables of `space` from the `FeatureStore` they were read from"
+        trainval, test, _ = self.tables[space]
+        missing = [c for c in L(target_col) if c not in trainval.columns]
+        if not missing or self.sources[space] is None: return
+        store = FeatureStore(self.sources[space])
+        if f'{space}_trainval' not in store: return
+        for j, df in enumerate((trainval, test)):
+            cols = store.load(f'{space}_{("trainval", "test")[j]}', missing)
+            df[missing] = cols.values
+            for (s, _), bases in self._bases.items():
+                if s == space: bases[j].items[missing] = cols.values
+
+    def _base(self, space:str, normalize:bool) -> Tuple[TabularPandas, TabularPandas]:
+        "(train_val, test) -`TabularPandas` without targets for `space`, built and normalized once"
+        if (space, normalize) not in self._bases:
+            trainval, test, feature_cols = self.tables[space]
+            procs = [Normalize] if normalize else None
+            self._bases[(space, normalize)] = (
+                TabularPandas(trainval, procs=procs, cont_names=feature_cols,
+                              splits=ColSplitter(col='is_valid')(trainval)),
+                TabularPandas(test, procs=procs, cont_names=feature_cols))
+        return self._bases[(space, normalize)]
+
+    def view(self, space:str, target_col, normalize:bool=True, log_y:bool=False) -> Tuple[TabularPandas, TabularPandas]:
+        """(train_val, test) -`TabularPandas` of feature space `space` ('las', 'image' or 'las_image') for `target_col`.
+        The feature columns and normalization statistics are shared between all views of the same `space`.
+        Optionally log-transform target column with np.log1p"""
+        if space not in self.tables: raise KeyError(f'No features for {space}, preprocess or load them first')
+        self._add_targets(space, target_col)
+        return tuple(_target_view(tb, target_col, log_y) for tb in self._base(space, normalize))
 
     def preprocess_lidar(self, target_col, path, min_h:float=1.5, mask_plot:bool=True, normalize:bool=True,
-                         log_y:bool=False, save_path:str=None) -> Tuple[TabularPandas, TabularPandas]:
-        "Preprocess data and return (train_val, test) -tuple. Optionally log-transform target column with np.log1p"
-        trainval = self.train_val_df.copy()
-        test = self.test_df.copy()
-        feature_cols = point_cloud_metric_cols
-        trainval[point_cloud_metric_cols] = trainval.progress_apply(lambda row: point_cloud_metrics(f'{path}/{row.sampleplotid}.las',
-                                                                                                    row.x, row.y,
-                                                                                                    min_h=min_h,
-                                                                                                    mask_plot=mask_plot),
-                                                                    axis=1, result_type='expand')
-        test[point_cloud_metric_cols] = test.progress_apply(lambda row: point_cloud_metrics(f'{path}/{row.sampleplotid}.las',
-                                                                                            row.x, row.y,
-                                                                                            min_h=min_h,
-                                                                                            mask_plot=mask_plot),
-                                                            axis=1, result_type='expand')
-
-        if log_y:
-            trainval[target_col] = np.log1p(trainval[target_col])
-            test[target_col] = np.log1p(test[target_col])
-
-        procs = None
-        if normalize:
-            procs = [Normalize]#.from_stats(*norm_stats)]
-        trainval_tb = TabularPandas(trainval, procs=procs,
-                                    cont_names=feature_cols, y_names=target_col,
-                                    splits=ColSplitter(col='is_valid')(trainval))
-        test_tb = TabularPandas(test, procs=procs,
-                                cont_names=feature_cols, y_names=target_col)
-        if save_path:
-            trainval.to_csv(f'{save_path}/las_trainval.csv', index=False)
-            test.to_csv(f'{save_path}/las_test.csv', index=False)
-            with open(f'{save_path}/las_features.txt', 'w') as f:
-                f.writelines("%s\n" % c for c in feature_cols)
-        return trainval_tb, test_tb
+                         log_y:bool=False, save_path:str=None, n_workers:int=defaults.cpus,
+                         incremental:bool=False) -> Tuple[TabularPandas, TabularPandas]:
+        """Preprocess data and return (train_val, test) -tuple. Optionally log-transform target column with np.log1p.
+        With `incremental`, per-plot features are kept in `save_path` and only new or changed plots are processed"""
+        feats = self._features('las', path, n_workers, self._store(save_path, incremental), min_h=min_h, mask_plot=mask_plot)
+        trainval, test, feature_cols = self._merge(feats)
+        if save_path: self._save(save_path, 'las', trainval, test, feature_cols)
+        self._set_tables('las', trainval, test, feature_cols, source=save_path)
+        return self.view('las', target_col, normalize, log_y)
 
     def load_las(self, path, target_col, normalize:bool=True, log_y:bool=False) -> Tuple[TabularPandas, TabularPandas]:
         "Load previously preprocessed las data"
-        trainval = pd.read_csv(f'{path}/las_trainval.csv')
-        test = pd.read_csv(f'{path}/las_test.csv')
-        with open(f'{path}/las_features.txt', 'r') as f:
-            feature_cols = [c.rstrip() for c in f.readlines()]
-
-        if log_y:
-            trainval[target_col] = np.log1p(trainval[target_col])
-            test[target_col] = np.log1p(test[target_col])
-        procs = None
-        if normalize:
-            procs = [Normalize]#.from_stats(*norm_stats)]
-        trainval_tb = TabularPandas(trainval, procs=procs,
-                                    cont_names=feature_cols, y_names=target_col,
-                                    splits=ColSplitter(col='is_valid')(trainval))
-        test_tb = TabularPandas(test, procs=procs,
-                                cont_names=feature_cols, y_names=target_col)
-        return trainval_tb, test_tb
+        self._load(path, 'las', target_col)
+        return self.view('las', target_col, normalize, log_y)
 
     def preprocess_image(self, target_col, path, radius:int=31, mask_plot:bool=True, normalize:bool=True,
-                         log_y:bool=False, save_path:str=None) -> Tuple[TabularPandas, TabularPandas]:
-        "Preprocess dataframes and return (train_val, test) -tuple"
-        trainval = self.train_val_df.copy()
-        test = self.test_df.copy()
-        #feature_cols = image_metric_cols
-        trainval_feats = []
-        for s in tqdm(trainval.sampleplotid.unique()):
-            feats = process_image_features(f'{path}/{s}.tif', mask_plot, radius)
-            feats['sampleplotid'] = s
-            trainval_feats.append(feats)
-        trainval_feats = pd.DataFrame(trainval_feats)
-        test_feats = []
-        for s in tqdm(test.sampleplotid.unique()):
-            feats = process_image_features(f'{path}/{s}.tif', mask_plot, radius)
-            feats['sampleplotid'] = s
-            test_feats.append(feats)
-        test_feats = pd.DataFrame(test_feats)
-        trainval = trainval.merge(trainval_feats, on='sampleplotid', how='left')
-        test = test.merge(test_feats, on='sampleplotid', how='left')
-
-        if log_y:
-            trainval[target_col] = np.log1p(trainval[target_col])
-            test[target_col] = np.log1p(test[target_col])
-        procs = None
-        if normalize:
-            procs = [Normalize]#.from_stats(*norm_stats)]
-        feature_cols = [k for k in trainval_feats.columns if k != 'sampleplotid']
-        trainval_tb = TabularPandas(trainval, procs=procs,
-                                    cont_names=feature_cols, y_names=target_col,
-                                    splits=ColSplitter(col='is_valid')(trainval))
-        test_tb = TabularPandas(test, procs=procs,
-                                cont_names=feature_cols, y_names=target_col)
-        if save_path:
-            trainval.to_csv(f'{save_path}/image_trainval.csv', index=False)
-            test.to_csv(f'{save_path}/image_test.csv', index=False)
-            with open(f'{save_path}/image_features.txt', 'w') as f:
-                f.writelines("%s\n" % c for c in feature_cols)
-        return trainval_tb, test_tb
+                         log_y:bool=False, save_path:str=None, n_workers:int=defaults.cpus,
+                         incremental:bool=False) -> Tuple[TabularPandas, TabularPandas]:
+        "Preprocess dataframes and return (train_val, test) -tuple. See `preprocess_lidar` for `incremental`"
+        feats = self._features('image', path, n_workers, self._store(save_path, incremental),
+                               mask_plot=mask_plot, radius=radius)
+        trainval, test, feature_cols = self._merge(feats)
+        if save_path: self._save(save_path, 'image', trainval, test, feature_cols)
+        self._set_tables('image', trainval, test, feature_cols, source=save_path)
+        return self.view('image', target_col, normalize, log_y)
 
     def load_image(self, path, target_col, normalize:bool=True, log_y:bool=False) -> Tuple[TabularPandas, TabularPandas]:
         "Load previously preprocessed image data"
-        trainval = pd.read_csv(f'{path}/image_trainval.csv')
-        test = pd.read_csv(f'{path}/image_test.csv')
-        with open(f'{path}/image_features.txt', 'r') as f:
-            feature_cols = [c.rstrip() for c in f.readlines()]
-
-        if log_y:
-            trainval[target_col] = np.log1p(trainval[target_col])
-            test[target_col] = np.log1p(test[target_col])
-        procs = None
-        if normalize:
-            procs = [Normalize]#.from_stats(*norm_stats)]
-        trainval_tb = TabularPandas(trainval, procs=procs,
-                                    cont_names=feature_cols, y_names=target_col,
-                                    splits=ColSplitter(col='is_valid')(trainval))
-        test_tb = TabularPandas(test, procs=procs,
-                                cont_names=feature_cols, y_names=target_col)
-        return trainval_tb, test_tb
+        self._load(path, 'image', target_col)
+        return self.view('image', target_col, normalize, log_y)
 
     def preprocess(self, target_col, path, lidar_pref, image_pref, min_h:float=1.5,
                    mask_plot:bool=True, normalize:bool=True, log_y:bool=False,
-                   save_path:str=None) -> Tuple[TabularPandas, TabularPandas]:
-        "Preprocess dataframes and return (train_val, test) -tuple"
-        trainval = self.train_val_df.copy()
-        test = self.test_df.copy()
-        feature_cols = point_cloud_metric_cols
-        trainval[point_cloud_metric_cols] = trainval.progress_apply(lambda row: point_cloud_metrics(f'{path}/{lidar_pref}/{row.sampleplotid}.las',
-                                                                                                    row.x, row.y,
-                                                                                                    min_h=min_h,
-                                                                                                    mask_plot=mask_plot),
-                                                                    axis=1, result_type='expand')
-        test[point_cloud_metric_cols] = test.progress_apply(lambda row: point_cloud_metrics(f'{path}/{lidar_pref}/{row.sampleplotid}.las',
-                                                                                            row.x, row.y,
-                                                                                            min_h=min_h,
-                                                                                            mask_plot=mask_plot),
-                                                            axis=1, result_type='expand')
-
-        trainval_feats = []
-        for s in tqdm(trainval.sampleplotid.unique()):
-            feats = process_image_features(f'{path}/{image_pref}/{s}.tif', mask_plot, radius=31)
-            feats['sampleplotid'] = s
-            trainval_feats.append(feats)
-        trainval_feats = pd.DataFrame(trainval_feats)
-        test_feats = []
-        for s in tqdm(test.sampleplotid.unique()):
-            feats = process_image_features(f'{path}/{image_pref}/{s}.tif', mask_plot, radius=31)
-            feats['sampleplotid'] = s
-            test_feats.append(feats)
-        test_feats = pd.DataFrame(test_feats)
-        trainval = trainval.merge(trainval_feats, on='sampleplotid', how='left')
-        test = test.merge(test_feats, on='sampleplotid', how='left')
-
-        feature_cols = feature_cols + [c for c in trainval_feats.columns if c != 'sampleplotid']
-
-        if log_y:
-            trainval[target_col] = np.log1p(trainval[target_col])
-            test[target_col] = np.log1p(test[target_col])
-        procs = None
-        if normalize:
-            procs = [Normalize]#.from_stats(*norm_stats)]
-        trainval_tb = TabularPandas(trainval, procs=procs,
-                                    cont_names=feature_cols, y_names=target_col,
-                                    splits=ColSplitter(col='is_valid')(trainval))
-        test_tb = TabularPandas(test, procs=procs,
-                                cont_names=feature_cols, y_names=target_col)
-
-        if save_path:
-            trainval.to_csv(f'{save_path}/las_image_trainval.csv', index=False)
-            test.to_csv(f'{save_path}/las_image_test.csv', index=False)
-            with open(f'{save_path}/las_image_features.txt', 'w') as f:
-                f.writelines("%s\n" % c for c in feature_cols)
-        return trainval_tb, test_tb
+                   save_path:str=None, n_workers:int=defaults.cpus,
+                   incremental:bool=False) -> Tuple[TabularPandas, TabularPandas]:
+        """Preprocess dataframes and return (train_val, test) -tuple. With `incremental`, the las and image features
+        already stored by `preprocess_lidar` and `preprocess_image` with the same settings are joined, not recomputed"""
+        store = self._store(save_path, incremental)
+        las_feats = self._features('las', f'{path}/{lidar_pref}', n_workers, store, min_h=min_h, mask_plot=mask_plot)
+        image_feats = self._features('image', f'{path}/{image_pref}', n_workers, store, mask_plot=mask_plot, radius=31)
+        trainval, test, feature_cols = self._merge(las_feats, image_feats)
+        if save_path: self._save(save_path, 'las_image', trainval, test, feature_cols)
+        self._set_tables('las_image', trainval, test, feature_cols, source=save_path)
+        return self.view('las_image', target_col, normalize, log_y)
 
     def load_las_image(self, path, target_col, normalize:bool=True, log_y:bool=False) -> Tuple[TabularPandas, TabularPandas]:
         "Load previously preprocessed image data"
-        trainval = pd.read_csv(f'{path}/las_image_trainval.csv')
-        test = pd.read_csv(f'{path}/las_image_test.csv')
-        with open(f'{path}/las_image_features.txt', 'r') as f:
-            feature_cols = [c.rstrip() for c in f.readlines()]
-
-        if log_y:
-            trainval[target_col] = np.log1p(trainval[target_col])
-            test[target_col] = np.log1p(test[target_col])
-        procs = None
-        if normalize:
-            procs = [Normalize]#.from_stats(*norm_stats)]
-        trainval_tb = TabularPandas(trainval, procs=procs,
-                                    cont_names=feature_cols, y_names=target_col,
-                                    splits=ColSplitter(col='is_valid')(trainval))
-        test_tb = TabularPandas(test, procs=procs,
-                                cont_names=feature_cols, y_names=target_col)
-        return trainval_tb, test_tb
+        self._load(path, 'las_image', target_col)
+        return self.view('las_image', target_col, normalize, log_y)
 
 
 # Cell
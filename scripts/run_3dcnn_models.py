@@ -22,6 +22,9 @@ def run_models(basedir, train_csv, valid_csv, test_csv, outdir):
     test_df = pd.read_csv(basedir/test_csv)
     df = pd.concat((train_df, valid_df))
     targets = ['v', 'd', 'h', 'g']
+    # Voxelize every plot once, all targets and ensemble members read the same store
+    store = VoxelStore.build(pd.concat((df, test_df)), basedir, basedir/'voxel_store', fn_col='sampleplitid',
+                             folder='AV_las', bin_voxels=False, bottom_voxels=False, mask_plot=False)
     for t in targets:
         # No voxel processing
         if not os.path.exists(f'{outdir}/{t}'): os.makedirs(f'{outdir}/{t}')
@@ -29,10 +32,11 @@ def run_models(basedir, train_csv, valid_csv, test_csv, outdir):
                                        bin_voxels=False,
                                        bottom_voxels=False,
                                        mask_plot=False,
+                                       voxel_store=store,
                                        y_block=RegressionBlock(),
                                        label_col=t,
                                        fn_col='sampleplitid', bs=32
-                                       batch_tfms=[DihedralItem])
+                                       batch_tfms=[VoxelDihedral()])
 
         y_max = train_df[t].max() * 1.1
 
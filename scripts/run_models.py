@@ -19,7 +19,8 @@ def run_models(data_path:str, outdir:str, log_y:bool=False):
     if not os.path.exists(outdir): os.makedirs(outdir)
     preprocessor = EnvecoPreprocessor(data_path/'AV.leaf.on.train.csv', 
                                       data_path/'AV.leaf.on.val.csv',
-                                      data_path/'AV.leaf.on.test.csv')
+                                      data_path/'AV.leaf.on.test.csv',
+                                      cache_dir=data_path/'feature_cache')
     for t in target_variables:
         if not os.path.exists(f'{outdir}/{t}'): os.makedirs(f'{outdir}/{t}')
         trainval_tb, test_tb = preprocessor.preprocess_lidar(target_col=t, 
@@ -35,7 +36,7 @@ def run_models(data_path:str, outdir:str, log_y:bool=False):
         ensemble = Ensemble(dls, learn_func=tabular_learner,
                             y_range=(0, y_max), 
                             metrics = [rmse, rrmse, bias, bias_pct, mae, R2Score()],
-                            n_models=10)
+                            n_models=10, stacked=True)
 
         ensemble.fit_one_cycle(20, 1e-2)
 
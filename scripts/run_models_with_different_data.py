@@ -30,7 +30,8 @@ def run_models(data_path:str, outdir:str, preprocess=False):
                                                     min_h=1.3,
                                                     normalize=True,
                                                     log_y=False,
-                                                    save_path='model_data')
+                                                    save_path='model_data',
+                                                    incremental=True)
 
         # Preprocess image data
         trainval_tb, test_tb = preprocessor.preprocess_image(target_col=['v_lp'], 
@@ -38,7 +39,8 @@ def run_models(data_path:str, outdir:str, preprocess=False):
                                                     mask_plot=True,
                                                     normalize=True,
                                                     log_y=False,
-                                                    save_path='model_data')
+                                                    save_path='model_data',
+                                                    incremental=True)
 
         # Preprocess both
         trainval_tb, test_tb = preprocessor.preprocess(target_col=['v_lp'], 
@@ -49,24 +51,19 @@ def run_models(data_path:str, outdir:str, preprocess=False):
                                                     min_h=1.3,
                                                     normalize=True,
                                                     log_y=False,
-                                                    save_path='model_data')
+                                                    save_path='model_data',
+                                                    incremental=True)
 
-    feature_space = ['las', 'image', 'both']
+    # Load each feature space once, every target and log setting is a view of the same features
+    preprocessor.load_las(path='model_data', target_col=target_variables[0])
+    preprocessor.load_image(path='model_data', target_col=target_variables[0])
+    preprocessor.load_las_image(path='model_data', target_col=target_variables[0])
+
+    feature_space = {'las': 'las', 'image': 'image', 'both': 'las_image'}
     log_tfm = [True, False]
 
     for target, feature, log_y in product(target_variables, feature_space, log_tfm):
-        if feature == 'las':
-            trainval_tb, test_tb = preprocessor.load_las(path='model_data', 
-                                                         target_col=target, 
-                                                         log_y=log_y)
-        if feature == 'image':
-            trainval_tb, test_tb = preprocessor.load_image(path='model_data',
-                                                           target_col=target,
-                                                           log_y=log_y)
-        if feature == 'both':
-            trainval_tb, test_tb= preprocessor.load_las_image(path='model_data',
-                                                              target_col=target,
-                                                              log_y=log_y)
+        trainval_tb, test_tb = preprocessor.view(feature_space[feature], target_col=target, log_y=log_y)
         savedir = f'{target}_{feature}{"_log" if log_y else ""}'
         if not os.path.exists(f'{outdir}/{savedir}'): os.makedirs(f'{outdir}/{savedir}')
 